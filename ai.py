@@ -0,0 +1,116 @@
+"""ai.py - Targeting for the computer opponent.
+
+The computer fires at the unguessed cell that the most legal ship
+placements pass through. A placement is legal if it covers no misses, and
+placements through cells already hit are weighted up by TARGET_WEIGHT, so
+the same density map hunts while there are no open hits and closes in on a
+ship once there are. Placement counts for every ship length are computed
+for the whole grid at once with sliding-window sums over NumPy arrays.
+
+On grids larger than WINDOW cells a side the map is only built for a
+WINDOW x WINDOW region, centred on a hit with an unguessed neighbour if
+there is one and placed at random otherwise, which keeps a move to a few
+milliseconds on any grid size."""
+
+import random
+
+import numpy as np
+
+from fleet import FLEET
+
+TARGET_WEIGHT = 50
+WINDOW = 64
+
+
+def _window_sums(grid, length):
+    '''Sums of every run of length cells along each row'''
+    sums = np.zeros((grid.shape[0], grid.shape[1] + 1))
+    sums[:, 1:] = np.cumsum(grid, axis=1)
+    return sums[:, length:] - sums[:, :-length]
+
+
+def _coverage(starts, length):
+    '''Spreads a weight per placement start over the cells it covers'''
+    rows, count = starts.shape
+    padded = np.zeros((rows, count + 2 * (length - 1)))
+    padded[:, length - 1:length - 1 + count] = starts
+    return _window_sums(padded, length)
+
+
+def density(size, hits, misses, lengths=FLEET):
+    '''Returns a size x size array weighting each cell by the placements
+    through it. Guessed cells are set to -1 so they are never chosen'''
+    hit = np.zeros((size, size))
+    miss = np.zeros((size, size))
+    hit.flat[list(hits)] = 1
+    miss.flat[list(misses)] = 1
+
+    total = np.zeros((size, size))
+    for length in lengths:
+        if length > size:
+            continue
+        for hit_grid, miss_grid, transposed in ((hit, miss, False),
+                                                (hit.T, miss.T, True)):
+            legal = _window_sums(miss_grid, length) == 0
+            weight = legal * (1 + TARGET_WEIGHT *
+                              _window_sums(hit_grid, length))
+            coverage = _coverage(weight, length)
+            total += coverage.T if transposed else coverage
+
+    total.flat[list(hits) + list(misses)] = -1
+    return total
+
+
+def _open_hit(size, hits, misses):
+    '''Returns a hit with an unguessed neighbour, or None'''
+    guessed = hits | misses
+    for index in hits:
+        x, y = index % size, index // size
+        for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1)):
+            nx, ny = x + dx, y + dy
+            if (0 <= nx < size and 0 <= ny < size and
+                    ny * size + nx not in guessed):
+                return index
+    return None
+
+
+def _local(cells, size, left, top):
+    '''Translates cell indices into a WINDOW-wide region'''
+    local = set()
+    for index in cells:
+        x, y = index % size - left, index // size - top
+        if 0 <= x < WINDOW and 0 <= y < WINDOW:
+            local.add(y * WINDOW + x)
+    return local
+
+
+def choose_target(size, hits, misses, rng=random):
+    '''Returns the [x, y] cell the computer fires at next, breaking ties
+    at random'''
+    hits = set(hits)
+    misses = set(misses)
+    if size <= WINDOW:
+        width, left, top = size, 0, 0
+        weights = density(size, hits, misses)
+    else:
+        width = WINDOW
+        centre = _open_hit(size, hits, misses)
+        if centre is None:
+            centre = rng.randrange(size * size)
+        left = min(max(centre % size - WINDOW // 2, 0), size - WINDOW)
+        top = min(max(centre // size - WINDOW // 2, 0), size - WINDOW)
+        weights = density(WINDOW,
+                          _local(hits, size, left, top),
+                          _local(misses, size, left, top))
+        if weights.max() < 0:
+            return _random_target(size, hits | misses, rng)
+    best = np.flatnonzero(weights == weights.max())
+    index = int(best[rng.randrange(len(best))])
+    return [index % width + left + 1, index // width + top + 1]
+
+
+def _random_target(size, guessed, rng):
+    while True:
+        index = rng.randrange(size * size)
+        if index not in guessed:
+            return [index % size + 1, index // size + 1]
@@ -0,0 +1,197 @@
+"""analytics.py - Packed game export format and cell frequency aggregation.
+
+export.py writes finished games to a file in this format, and the
+aggregator reads it back a record at a time, so neither side holds more
+than one batch of games in memory. No App Engine imports, so the
+aggregation runs anywhere NumPy does.
+
+The file starts with MAGIC and a little-endian uint32 format version,
+followed by one record per game, each prefixed by its length in bytes as
+a uint32. A record is:
+    - uint32 grid size, uint8 winner (0 for canceled, else 1 or 2),
+      uint32 move count
+    - each player's board as grid.pack_layers(ships, hits, misses)
+    - the moves as three columns: uint32 cell indices, uint8 player
+      (1 or 2), uint8 result (see RESULTS)"""
+
+import re
+import struct
+
+from grid import cell, pack_layers
+
+MAGIC = 'BSHX'
+FORMAT_VERSION = 1
+RESULTS = {'Miss': 0, 'Hit': 1, 'Win': 2}
+FLUSH_CELLS = 1 << 20
+
+_RECORD_HEADER = struct.Struct('<IBI')
+_LENGTH = struct.Struct('<I')
+_MOVE = re.compile(r'^name-(.*)\.coord-(\d+)_(\d+)\.result-(\w+)$')
+
+
+def pack_game(grid_size, players, winner, boards, moves):
+    """Packs one finished game into a record.
+    Args:
+        grid_size: Width of the board
+        players: (player_1, player_2) user names
+        winner: Name of the winner, or 'CANCELED'
+        boards: [(ships, hits, misses)] sets of cell indices for player 1
+            and player 2
+        moves: Move strings, as returned by Game.get_moves
+    Returns:
+        The record as a byte string, length prefix included."""
+    winner_slot = players.index(winner) + 1 if winner in players else 0
+    move_cells = []
+    move_players = []
+    move_results = []
+    for move in moves:
+        match = _MOVE.match(move)
+        if not match or match.group(1) not in players:
+            continue
+        name, x, y, result = match.groups()
+        move_cells.append(cell(int(x), int(y), grid_size))
+        move_players.append(players.index(name) + 1)
+        move_results.append(RESULTS.get(result, 0))
+
+    count = len(move_cells)
+    record = ''.join(
+        [_RECORD_HEADER.pack(grid_size, winner_slot, count)] +
+        [pack_layers(*board) for board in boards] +
+        [struct.pack('<{}I'.format(count), *move_cells),
+         struct.pack('<{}B'.format(count), *move_players),
+         struct.pack('<{}B'.format(count), *move_results)])
+    return _LENGTH.pack(len(record)) + record
+
+
+def file_header():
+    return MAGIC + struct.pack('<I', FORMAT_VERSION)
+
+
+def read_games(path):
+    """Reads an export one record at a time.
+    Args:
+        path: Path of a file written by export.py
+    Returns:
+        A generator of dicts with grid_size, winner, boards (a list of two
+        (ships, hits, misses) uint32 arrays) and the move columns cells,
+        players and results as NumPy arrays."""
+    import numpy as np
+
+    with open(path, 'rb') as export:
+        header = export.read(len(file_header()))
+        if header[:len(MAGIC)] != MAGIC:
+            raise ValueError('Not a game export: {}'.format(path))
+        while True:
+            prefix = export.read(_LENGTH.size)
+            if not prefix:
+                return
+            record = export.read(_LENGTH.unpack(prefix)[0])
+            grid_size, winner, count = _RECORD_HEADER.unpack_from(record)
+            offset = _RECORD_HEADER.size
+            boards = []
+            for _ in range(2):
+                sizes = struct.unpack_from('<3I', record, offset)
+                offset += 12
+                layers = []
+                for size in sizes:
+                    layers.append(np.frombuffer(record, '<u4', size, offset))
+                    offset += 4 * size
+                boards.append(tuple(layers))
+            cells = np.frombuffer(record, '<u4', count, offset)
+            offset += 4 * count
+            players = np.frombuffer(record, 'u1', count, offset)
+            results = np.frombuffer(record, 'u1', count, offset + count)
+            yield {'grid_size': grid_size,
+                   'winner': winner,
+                   'boards': boards,
+                   'cells': cells,
+                   'players': players,
+                   'results': results}
+
+
+class _CellCounts(object):
+    '''Per-cell counts for one grid size. Cell indices are buffered and
+    counted with one bincount per FLUSH_CELLS, so the cost per game does
+    not depend on the grid area'''
+    def __init__(self, size):
+        import numpy as np
+        self.size = size
+        self.counts = np.zeros(size * size, dtype=np.int64)
+        self._pending = []
+        self._pending_cells = 0
+
+    def add(self, cells):
+        self._pending.append(cells)
+        self._pending_cells += len(cells)
+        if self._pending_cells >= FLUSH_CELLS:
+            self.flush()
+
+    def flush(self):
+        import numpy as np
+        if self._pending:
+            self.counts += np.bincount(np.concatenate(self._pending),
+                                       minlength=self.size * self.size)
+        self._pending = []
+        self._pending_cells = 0
+
+    def grid(self):
+        self.flush()
+        return self.counts.reshape(self.size, self.size)
+
+
+def cell_frequencies(path):
+    """Aggregates an export into per-cell frequencies.
+    Args:
+        path: Path of a file written by export.py
+    Returns:
+        A dict of grid size to a dict of:
+            games: Number of finished games on that grid
+            ships, hits, guesses: size x size arrays counting how often
+                each cell held a ship, was hit and was guessed
+            ship_rate, hit_rate: ships and hits per game and per guess for
+                each cell (0 where a cell was never guessed)
+            shots_to_win: Mean number of the winner's guesses per won game
+            accuracy: Mean share of the winner's guesses that hit"""
+    import numpy as np
+
+    totals = {}
+    for game in read_games(path):
+        size = game['grid_size']
+        if size not in totals:
+            totals[size] = {'games': 0, 'won': 0, 'shots': 0,
+                            'accuracy': 0.0,
+                            'ships': _CellCounts(size),
+                            'hit_cells': _CellCounts(size),
+                            'guesses': _CellCounts(size)}
+        total = totals[size]
+        total['games'] += 1
+        for ships, hits, misses in game['boards']:
+            total['ships'].add(ships)
+            total['hit_cells'].add(hits)
+            total['guesses'].add(hits)
+            total['guesses'].add(misses)
+        if game['winner']:
+            by_winner = game['players'] == game['winner']
+            shots = int(by_winner.sum())
+            hits = int((game['results'][by_winner] > 0).sum())
+            total['won'] += 1
+            total['shots'] += shots
+            total['accuracy'] += float(hits) / shots if shots else 0.0
+
+    frequencies = {}
+    for size, total in totals.items():
+        ships = total['ships'].grid()
+        hits = total['hit_cells'].grid()
+        guesses = total['guesses'].grid()
+        won = total['won'] or 1
+        frequencies[size] = {
+            'games': total['games'],
+            'ships': ships,
+            'hits': hits,
+            'guesses': guesses,
+            'ship_rate': ships / float(total['games']),
+            'hit_rate': np.where(guesses > 0,
+                                 hits / np.maximum(guesses, 1.0), 0.0),
+            'shots_to_win': total['shots'] / float(won),
+            'accuracy': total['accuracy'] / won}
+    return frequencies
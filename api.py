@@ -1,24 +1,39 @@
 import endpoints
 from protorpc import remote, messages
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
 
-from models import User, Game, Board
+from models import User, Game, Board, ArchivedGame
 from models import (
     StringMessage,
     BoardForm,
     NewGameForm,
     InsertShipForm,
+    InsertFleetForm,
     MakeGuessForm,
     CoordsForm,
     PlayerStatsForm,
     PlayersStatsForm,
     ActiveGamesForm,
     GameForm,
-    GameHistoryForm)
-
-from utils import get_by_urlsafe
+    GameHistoryForm,
+    ArchivedGameForm,
+    NewTournamentForm,
+    TournamentForm,
+    MatchmakingForm,
+    MatchForm)
+
+import gamecache
+import leaderboard
+import metrics
+import tournament
+from engine import COMPUTER_NAME, GameEngine, InvalidRequest, NotFound
+from grid import DEFAULT_GRID_SIZE
+from storage import NdbStorage
+from utils import (
+    MAX_PAGE_SIZE,
+    fetch_page,
+    get_by_urlsafe,
+    get_key_by_urlsafe)
 
 NEW_GAME_REQUEST = endpoints.ResourceContainer(NewGameForm)
 
@@ -27,36 +42,132 @@ URLSAFE_GAME_REQUEST = endpoints.ResourceContainer(
 
 MAKE_GUESS_REQUEST = endpoints.ResourceContainer(
                         MakeGuessForm,
-                        urlsafe_game_key=messages.StringField(1),)
+                        urlsafe_game_key=messages.StringField(1),
+                        if_version=messages.IntegerField(2),)
 
 INSERT_SHIP_REQUEST = endpoints.ResourceContainer(
                         InsertShipForm,)
 
+INSERT_FLEET_REQUEST = endpoints.ResourceContainer(
+                        InsertFleetForm,)
+
 NEW_USER = endpoints.ResourceContainer(name=messages.StringField(1),
                                        email=messages.StringField(2))
 
 PLAYER_REQUEST = endpoints.ResourceContainer(
                         user_name=messages.StringField(1))
 
+PAGE_REQUEST = endpoints.ResourceContainer(
+                        page_size=messages.IntegerField(1),
+                        cursor=messages.StringField(2),)
+
+ACTIVE_GAMES_REQUEST = endpoints.ResourceContainer(
+                        page_size=messages.IntegerField(1),
+                        cursor=messages.StringField(2),
+                        if_version=messages.IntegerField(3),)
+
+PLAYER_PAGE_REQUEST = endpoints.ResourceContainer(
+                        user_name=messages.StringField(1),
+                        page_size=messages.IntegerField(2),
+                        cursor=messages.StringField(3),)
+
+GAME_HISTORY_REQUEST = endpoints.ResourceContainer(
+                        urlsafe_game_key=messages.StringField(1),
+                        since_move=messages.IntegerField(2),
+                        limit=messages.IntegerField(3),
+                        if_version=messages.IntegerField(4),)
+
+NEW_TOURNAMENT_REQUEST = endpoints.ResourceContainer(NewTournamentForm)
+
+TOURNAMENT_REQUEST = endpoints.ResourceContainer(
+                        urlsafe_tournament_key=messages.StringField(1),)
+
+MATCHMAKING_REQUEST = endpoints.ResourceContainer(MatchmakingForm)
+
 SHIP_COORDS_REQUEST = endpoints.ResourceContainer(
                         urlsafe_game_key=messages.StringField(1),
                         player_name=messages.StringField(2),)
 
-GRID_SIZE = 10
+STORAGE = NdbStorage()
+ENGINE = GameEngine(STORAGE)
+
+
+def _call(method, *args):
+    '''Calls an engine method, raising the endpoints exception matching
+    any GameError'''
+    try:
+        return method(*args)
+    except NotFound as e:
+        raise endpoints.NotFoundException(str(e))
+    except InvalidRequest as e:
+        raise endpoints.BadRequestException(str(e))
+
+
+def _game_form(game, message=''):
+    '''Renders an engine GameState as a GameForm'''
+    return GameForm(urlsafe_key=game.key,
+                    p1_name=game.player_1,
+                    p2_name=game.player_2,
+                    next_player=game.next_player,
+                    game_over=game.game_over,
+                    winner=game.winner,
+                    message=message,
+                    grid_size=game.grid_size,
+                    version=game.version)
+
+
+def _board_form(urlsafe_game_key, outcome):
+    '''Renders the board of an engine Outcome as a BoardForm'''
+    board = outcome.board
+    return BoardForm(urlsafe_key=urlsafe_game_key,
+                     hits=len(board.hits),
+                     misses=len(board.misses),
+                     remaining=board.remaining,
+                     message=outcome.message,
+                     version=outcome.version)
+
+
+def _tournament_form(tournament, games, message=''):
+    return TournamentForm(urlsafe_key=tournament.key.urlsafe(),
+                          format=tournament.format,
+                          round=tournament.round,
+                          games=[_game_form(game) for game in games],
+                          byes=tournament.byes,
+                          winner=tournament.winner,
+                          message=message)
+
+
+def _game_version(urlsafe_game_key):
+    '''Returns the cached (version, next_player) of a game'''
+    version = _call(STORAGE.get_version, urlsafe_game_key)
+    if version is None:
+        raise endpoints.NotFoundException('Game not found!')
+    return version
 
 
 @endpoints.api(name='battleship', version='v1')
 class BattleshipApi(remote.Service):
     '''Game API'''
 
-    @endpoints.method(response_message=ActiveGamesForm,
+    @endpoints.method(request_message=ACTIVE_GAMES_REQUEST,
+                      response_message=ActiveGamesForm,
                       path='game/list',
                       name='list_active_games',
                       http_method='GET')
     def list_active_games(self, request):
-        '''Returns a list of data for all in-progress games'''
-        games = Game.query(Game.game_over == False).fetch()
-        return ActiveGamesForm(items=[game.to_form() for game in games])
+        '''Returns a page of data for in-progress games. If no game has
+        changed since version if_version, returns only not_modified'''
+        # read before the query, so a change during it makes the next
+        # poll fetch the list again
+        version = gamecache.get_list_version()
+        if request.if_version is not None and request.if_version == version:
+            return ActiveGamesForm(version=version, not_modified=True)
+        games, next_cursor = fetch_page(Game.query(Game.game_over == False),
+                                        request.page_size,
+                                        request.cursor)
+        return ActiveGamesForm(items=Game.to_forms(games),
+                               next_cursor=next_cursor,
+                               version=version)
 
     @endpoints.method(request_message=NEW_USER,
                       response_message=StringMessage,
@@ -65,12 +176,14 @@ class BattleshipApi(remote.Service):
                       http_method='POST')
     def create_user(self, request):
         '''Create a user. Requires unique username'''
-        test = User.query(User.user_name == request.name).get()
-        if test:
+        if request.name == COMPUTER_NAME:
             raise endpoints.ConflictException(
-                'A user with that name already exists!')
-        user = User(user_name=request.name, email=request.email)
-        user.put()
+                'That name is reserved for the computer!')
+        try:
+            NdbStorage.create_user_async(request.name,
+                                         request.email).get_result()
+        except InvalidRequest as e:
+            raise endpoints.ConflictException(str(e))
         return StringMessage(message='Welcome, {}'.format(request.name))
 
     @endpoints.method(request_message=NEW_GAME_REQUEST,
@@ -80,46 +193,56 @@ class BattleshipApi(remote.Service):
                       http_method='POST')
     def new_game(self, request):
         '''Creates new game'''
-        p1 = User.query(User.user_name == request.p1_username).get()
-        p2 = User.query(User.user_name == request.p2_username).get()
-
-        # check to verify players aren't already in ongoing game
-        check = Game.query(ndb.OR(Game.player_1 == p1.key,
-                                  Game.player_2 == p1.key))
-        check = check.filter(ndb.OR(Game.player_1 == p2.key,
-                                    Game.player_2 == p2.key))
-        check = check.filter(Game.game_over == False).get()
-        if check:
-            raise endpoints.BadRequestException('These players already have \
-                                          an active game!')
-
-        try:
-            game = Game.new_game(p1.key, p2.key)
-
-        except ValueError:
-            raise endpoints.BadRequestException('Both players must be \
-                                                 valid users!')
-
-        urlsafe_game_key = game.key.urlsafe()
-
-        p1_board = Board(player=p1.key,
-                         opponent=p2.key,
-                         urlsafe_game_key=urlsafe_game_key,
-                         hit_coord=[],
-                         ship_coord=[],
-                         miss_coord=[])
-        p1_board.put()
-
-        p2_board = Board(player=p2.key,
-                         opponent=p1.key,
-                         urlsafe_game_key=urlsafe_game_key,
-                         hit_coord=[],
-                         ship_coord=[],
-                         miss_coord=[])
-        p2_board.put()
+        game = _call(ENGINE.new_game, request.p1_username,
+                     request.p2_username,
+                     request.grid_size or DEFAULT_GRID_SIZE)
+        return _game_form(game, message='The game is afoot!')
+
+    @endpoints.method(request_message=NEW_TOURNAMENT_REQUEST,
+                      response_message=TournamentForm,
+                      path='tournament/new',
+                      name='create_tournament',
+                      http_method='POST')
+    def create_tournament(self, request):
+        '''Creates every game of a round robin, or the first round of a
+        bracket, in one batch'''
+        created, games = _call(tournament.create, ENGINE, request.format,
+                               list(request.player_names),
+                               request.grid_size or DEFAULT_GRID_SIZE)
+        return _tournament_form(created, games,
+                                message='Let the tournament begin!')
+
+    @endpoints.method(request_message=TOURNAMENT_REQUEST,
+                      response_message=TournamentForm,
+                      path='tournament/{urlsafe_tournament_key}/next_round',
+                      name='next_tournament_round',
+                      http_method='PUT')
+    def next_tournament_round(self, request):
+        '''Starts a bracket's next round once every game of the current
+        round is over, or names the winner after the final'''
+        tournament_key = get_key_by_urlsafe(request.urlsafe_tournament_key)
+        played, games = _call(tournament.next_round, ENGINE, tournament_key)
+        if played.winner:
+            message = '{} won the tournament!'.format(played.winner)
+        else:
+            message = 'Round {} is afoot!'.format(played.round)
+        return _tournament_form(played, games, message=message)
 
-        taskqueue.add(url='/tasks/updateactivegames')
-        return game.to_form(message='The game is afoot!')
+    @endpoints.method(request_message=MATCHMAKING_REQUEST,
+                      response_message=MatchForm,
+                      path='matchmaking',
+                      name='join_matchmaking',
+                      http_method='POST')
+    def join_matchmaking(self, request):
+        '''Starts a game against the player who has waited longest for one
+        on the same grid size, or queues the player until someone joins'''
+        game = _call(tournament.join_queue, ENGINE, request.user_name,
+                     request.grid_size or DEFAULT_GRID_SIZE)
+        if not game:
+            return MatchForm(message='Waiting for an opponent. You will be '
+                                     'emailed when your game starts.')
+        return MatchForm(message='The game is afoot!',
+                         game=_game_form(game))
 
     @endpoints.method(request_message=URLSAFE_GAME_REQUEST,
                       response_message=StringMessage,
@@ -128,15 +251,7 @@ class BattleshipApi(remote.Service):
                       http_method='PUT')
     def cancel_game(self, request):
         '''Allows cancellation of a game before it has been won'''
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-
-        # validate game is still in play before canceling
-        if game.game_over:
-            raise endpoints.BadRequestException("Game is already over!")
-
-        game.game_over = True
-        game.winner = 'CANCELED'
-        game.put()
+        _call(ENGINE.cancel, request.urlsafe_game_key)
         return StringMessage(message="Game "
                              "{} is canceled".format(request.urlsafe_game_key))
 
@@ -146,75 +261,21 @@ class BattleshipApi(remote.Service):
                       name='make_guess',
                       http_method='PUT')
     def make_guess(self, request):
-        '''Makes a guess, returns board state with message'''
-        game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        player = User.query(User.user_name == request.player_name).get()
-        if player.key == game.player_1:
-            opponent = User.query(User.key == game.player_2).get()
-        if player.key == game.player_2:
-            opponent = User.query(User.key == game.player_1).get()
-
-        g_key = request.urlsafe_game_key
-        board = Board.query(ndb.AND(Board.player == opponent.key,
-                                    Board.urlsafe_game_key == g_key)).get()
-        if player.key != game.next_player:
-            return board.to_form(message="It's not your turn yet!")
-
-        if game.game_over:
-            winner = game.winner
-            return board.to_form(message='Game already over,'
-                                 '{} won!'.format(winner))
-
-        ship_coords = board.giveCoords('ship')
-        miss_coords = board.giveCoords('miss')
-        hit_coords = board.giveCoords('hit')
-
-        guess_coord = [request.guess_x, request.guess_y]
-
-        # verifies guess is within board
-        if not set(guess_coord).issubset(set(range(1, GRID_SIZE + 1))):
-            raise endpoints.BadRequestException("Guess outside of board range")
-
-        # checks if the guess has already been entered
-        if guess_coord in miss_coords or guess_coord in hit_coords:
-            return board.to_form(message="You've already guessed"
-                                         "those coordinates!")
-
-        # if guess is novel, checks for a hit
-        if guess_coord in ship_coords:
-            board.hit_coord.append('{}_{}'.format(*guess_coord))
-            board.put()
-            hit_coords = board.giveCoords('hit')
-
-            # in a hit, checks if all ship cells are hit, announces win if so
-            if len(ship_coords) == len(hit_coords):
-                game.game_over = True
-                game.winner = player.user_name
-                game.put()
-
-                game.insert_move(player.user_name, guess_coord, 'Win')
-
-                player.games_won = player.games_won + 1
-                player.games_played = player.games_played + 1
-                player.put()
-
-                opponent.games_played = opponent.games_played + 1
-                opponent.put()
-                return board.to_form('Congrats, you won!')
-
-            # if not the final hit, notifies user
-            game.next_player = opponent.key
-            game.put()
-            game.insert_move(player.user_name, guess_coord, 'Hit')
-            return board.to_form('A hit! Keep going!')
-
-        board.miss_coord.append('{}_{}'.format(*guess_coord))
-        board.put()
-
-        game.next_player = opponent.key
-        game.put()
-        game.insert_move(player.user_name, guess_coord, 'Miss')
-        return board.to_form('Sorry, you missed!')
+        '''Makes a guess, returns board state with message. A player
+        polling with the if_version they last saw gets only not_modified
+        while it is still not their turn'''
+        if request.if_version is not None:
+            version, next_player = _game_version(request.urlsafe_game_key)
+            if (version == request.if_version and
+                    next_player != request.player_name):
+                return BoardForm(urlsafe_key=request.urlsafe_game_key,
+                                 message="It's not your turn yet!",
+                                 version=version,
+                                 not_modified=True)
+        outcome = _call(ENGINE.guess, request.urlsafe_game_key,
+                        request.player_name, request.guess_x,
+                        request.guess_y)
+        return _board_form(request.urlsafe_game_key, outcome)
 
     @endpoints.method(request_message=INSERT_SHIP_REQUEST,
                       response_message=BoardForm,
@@ -223,47 +284,24 @@ class BattleshipApi(remote.Service):
                       http_method='PUT')
     def insert_ship(self, request):
         '''Adds a new ship to player's board'''
-        player = User.query(User.user_name == request.player_name).get()
-        g_key = request.urlsafe_game_key
-        board = Board.query(ndb.AND(Board.player == player.key,
-                                    Board.urlsafe_game_key == g_key)).get()
-
-        if not board:
-            return BoardForm(message='Board not found.')
-
-        # create the array with all coordinates for new ship
-        new_ship = []
-        new_ship.append((request.start_x, request.start_y))
-        if request.horizontal:
-            for i in range(1, request.length):
-                new_ship.append((request.start_x + i, request.start_y))
-        if not request.horizontal:
-            for i in range(1, request.length):
-                new_ship.append((request.start_x, request.start_y+i))
-
-        existing_ship_coords = board.giveCoords('ship')
-        print existing_ship_coords
-        print new_ship
-        for coord in new_ship:
-            # checks for overlap with existing ships
-            if coord in existing_ship_coords:
-                return board.to_form('That ship overlaps another. \
-                                     Try again!')
-
-            # checks that all coordinates are on the board
-            inBounds = True
-            if coord[0] > GRID_SIZE or coord[1] > GRID_SIZE:
-                inBounds = False
-            if coord[0] < 1 or coord[1] < 1:
-                inBounds = False
-            if not inBounds:
-                return board.to_form('That ship goes off the board. \
-                                     Try again!')
-
-        board.ship_coord = [('{}_{}').format(*coord) for coord in new_ship]
-        board.put()
-
-        return board.to_form(message='Ship added successfully!')
+        outcome = _call(ENGINE.place_ship, request.urlsafe_game_key,
+                        request.player_name, request.start_x,
+                        request.start_y, request.length, request.horizontal)
+        return _board_form(request.urlsafe_game_key, outcome)
+
+    @endpoints.method(request_message=INSERT_FLEET_REQUEST,
+                      response_message=BoardForm,
+                      path='board/insert_fleet',
+                      name='insert_fleet',
+                      http_method='PUT')
+    def insert_fleet(self, request):
+        '''Places a player's whole fleet, replacing any ships already
+        placed. Without ships, places the standard fleet at random'''
+        ships = [(ship.start_x, ship.start_y, ship.length, ship.horizontal)
+                 for ship in request.ships]
+        outcome = _call(ENGINE.place_fleet, request.urlsafe_game_key,
+                        request.player_name, ships)
+        return _board_form(request.urlsafe_game_key, outcome)
 
     @endpoints.method(request_message=PLAYER_REQUEST,
                       response_message=PlayerStatsForm,
@@ -272,20 +310,51 @@ class BattleshipApi(remote.Service):
                       http_method='GET')
     def player_stats(self, request):
         '''returns player stat info for a given player'''
-        player = User.query(User.user_name == request.user_name).get()
+        player = User.key_for(request.user_name).get()
         if not player:
             raise ValueError('Player does not exist!')
         return player.to_form()
 
-    @endpoints.method(response_message=PlayersStatsForm,
+    @endpoints.method(request_message=PAGE_REQUEST,
+                      response_message=PlayersStatsForm,
                       path='player',
                       name='get_user_rankings',
                       http_method='GET')
     def get_user_rankings(self, request):
-        '''returns player stat info for all players'''
-        players = User.query().order(-User.win_pctg)
+        '''returns a page of player stat info, best win percentage first'''
+        if not request.cursor and request.page_size in (None,
+                                                        leaderboard.TOP_K):
+            players, next_cursor = leaderboard.get_top()
+        else:
+            players, next_cursor = fetch_page(
+                User.query().order(-User.win_pctg),
+                request.page_size,
+                request.cursor)
         return PlayersStatsForm(players=[player.to_form()
-                                         for player in players])
+                                         for player in players],
+                                next_cursor=next_cursor)
+
+    @endpoints.method(request_message=PLAYER_REQUEST,
+                      response_message=PlayerStatsForm,
+                      path='player/{user_name}/rank',
+                      name='get_user_rank',
+                      http_method='GET')
+    def get_user_rank(self, request):
+        '''returns player stat info along with the player's overall rank'''
+        player, histogram = self._get_rank_data_async(
+            request.user_name).get_result()
+        if not player:
+            raise endpoints.NotFoundException('Player does not exist!')
+        return player.to_form(rank=leaderboard.get_rank(player.win_pctg,
+                                                        histogram))
+
+    @staticmethod
+    @ndb.tasklet
+    def _get_rank_data_async(user_name):
+        '''Fetches a user and the leaderboard histogram concurrently'''
+        result = yield (User.key_for(user_name).get_async(),
+                        leaderboard.get_histogram_async())
+        raise ndb.Return(result)
 
     @endpoints.method(request_message=SHIP_COORDS_REQUEST,
                       response_message=CoordsForm,
@@ -295,45 +364,74 @@ class BattleshipApi(remote.Service):
     def get_ship_coords(self, request):
         '''Given a player and opponent name, returns the player's
         list of ships on the game board'''
-        player = User.query(User.user_name == request.player_name).get()
-        g_key = request.urlsafe_game_key
-        board = Board.query(ndb.AND(Board.player == player.key,
-                                    Board.urlsafe_game_key == g_key)).get()
-        return CoordsForm(coord=[coord for coord in board.ship_coord])
-
-    @endpoints.method(request_message=URLSAFE_GAME_REQUEST,
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key)
+        player_key = User.key_for(request.player_name)
+        boards = ndb.get_multi([Board.key_for(game_key, 1),
+                                Board.key_for(game_key, 2)])
+        for board in boards:
+            if board and board.player == player_key:
+                return board.coordsToForm('ship')
+        raise endpoints.NotFoundException('Board not found!')
+
+    @endpoints.method(request_message=GAME_HISTORY_REQUEST,
                       response_message=GameHistoryForm,
                       path='game/{urlsafe_game_key}/history',
                       name='get_game_history',
                       http_method='GET')
     def get_game_history(self, request):
-        '''Returns a list of moves made in game, with player and result'''
+        '''Returns moves made in game after since_move, with player and
+        result, so polling clients only fetch new moves. If the game is
+        still at version if_version, returns only not_modified'''
+        if request.since_move is not None and request.since_move < 0:
+            raise endpoints.BadRequestException('Invalid since_move')
+        if request.limit is not None and request.limit < 0:
+            raise endpoints.BadRequestException('Invalid limit')
+        if request.if_version is not None:
+            version, _ = _game_version(request.urlsafe_game_key)
+            if version == request.if_version:
+                return GameHistoryForm(version=version, not_modified=True)
         game = get_by_urlsafe(request.urlsafe_game_key, Game)
-        return GameHistoryForm(items=[move for move in game.moves])
+        if not game:
+            raise endpoints.NotFoundException('Game not found! Finished '
+                                              'games may be archived.')
+        limit = min(request.limit or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+        return GameHistoryForm(items=game.get_moves(request.since_move or 0,
+                                                    limit),
+                               last_move=game.last_move(),
+                               version=game.version)
 
-    @endpoints.method(request_message=PLAYER_REQUEST,
+    @endpoints.method(request_message=URLSAFE_GAME_REQUEST,
+                      response_message=ArchivedGameForm,
+                      path='game/{urlsafe_game_key}/archive',
+                      name='get_archived_game',
+                      http_method='GET')
+    def get_archived_game(self, request):
+        '''Returns the players, result and full move history of a game
+        that has been archived'''
+        game_key = get_key_by_urlsafe(request.urlsafe_game_key)
+        archive = ArchivedGame.key_for(game_key).get()
+        if not archive:
+            raise endpoints.NotFoundException('Archived game not found!')
+        return archive.to_form()
+
+    @endpoints.method(request_message=PLAYER_PAGE_REQUEST,
                       response_message=ActiveGamesForm,
                       path='player/{user_name}/games',
                       name='get_user_games',
                       http_method='GET')
     def get_user_games(self, request):
-        '''Returns a list of data for all a player's in-progress games'''
-        player = User.query(User.user_name == request.user_name).get()
-        games = Game.query(ndb.OR(Game.player_1 == player.key,
-                                  Game.player_2 == player.key))
-        games = games.filter(Game.game_over == False).fetch()
-        return ActiveGamesForm(items=[game.to_form() for game in games])
-
-    @staticmethod
-    def _cache_gameCount():
-        '''Populates memcount with a number of active games'''
-        games = Game.query(Game.game_over == False).fetch()
-        if games:
-            count = len(games)
-        else:
-            count = 0
-        memcache.set('ACTIVE_GAMES',
-                     'There are {} game in play right now.'.format(count))
-
-
-api = endpoints.api_server([BattleshipApi])
+        '''Returns a page of data for a player's in-progress games'''
+        player_key = User.key_for(request.user_name)
+        games = Game.query(ndb.OR(Game.player_1 == player_key,
+                                  Game.player_2 == player_key))
+        # OR queries only support cursors when ordered by key
+        games = games.filter(Game.game_over == False).order(Game.key)
+        games, next_cursor = fetch_page(games,
+                                        request.page_size,
+                                        request.cursor)
+        return ActiveGamesForm(items=Game.to_forms(games),
+                               next_cursor=next_cursor)
+
+
+api = metrics.instrument(endpoints.api_server([BattleshipApi]),
+                         BattleshipApi.all_remote_methods().keys())
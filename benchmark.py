@@ -0,0 +1,334 @@
+"""benchmark.py - Load test the API under the local App Engine testbed.
+
+Creates users, starts games, places fleets and plays every game to the
+end by calling BattleshipApi directly, with the datastore, memcache and
+taskqueue replaced by the SDK's local stubs. For each endpoint it reports
+latency percentiles and the datastore and memcache RPCs, entity reads and
+entity writes per call, which are counted with apiproxy hooks. The RPC
+counts do not depend on the machine, so a change that adds work to an
+endpoint shows up in them even when the latencies are noisy.
+
+With --startup it measures instance start up instead: how long importing
+each entry module takes in a fresh interpreter, and how long the
+/_ah/warmup request takes on a new instance.
+
+Run it with the App Engine SDK available:
+
+    python benchmark.py --sdk ~/google_appengine --games 100 --concurrency 8
+    python benchmark.py --sdk ~/google_appengine --startup
+"""
+
+import argparse
+import collections
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+
+PERCENTILES = (50, 90, 99)
+STARTUP_MODULES = ('main', 'api', 'models', 'storage', 'ai')
+
+# run in a fresh interpreter per measurement, so nothing is imported yet
+_IMPORT_TIMER = '''
+import sys, time
+sys.path.insert(0, {root!r})
+import benchmark
+benchmark.setup_sdk({sdk!r})
+start = time.time()
+import {module}
+print(time.time() - start)
+'''
+
+
+def _percentile(ordered, pct):
+    '''Nearest-rank percentile of a sorted list'''
+    if not ordered:
+        return 0
+    rank = max(int(round(pct / 100.0 * len(ordered))), 1)
+    return ordered[rank - 1]
+
+
+class Recorder(object):
+    '''Collects latencies and RPC counts per endpoint. The endpoint being
+    called is tracked per thread, so concurrent calls are attributed to
+    the right endpoint'''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.latencies = collections.defaultdict(list)
+        self.counts = collections.defaultdict(collections.Counter)
+
+    def call(self, name, method, request):
+        self._local.endpoint = name
+        start = time.time()
+        try:
+            return method(request)
+        finally:
+            elapsed = (time.time() - start) * 1000
+            self._local.endpoint = None
+            with self._lock:
+                self.latencies[name].append(elapsed)
+
+    def _add(self, counts):
+        name = getattr(self._local, 'endpoint', None)
+        if name is None:
+            return
+        with self._lock:
+            self.counts[name].update(counts)
+
+    def datastore_hook(self, service, call, request, response):
+        counts = {'datastore_rpcs': 1}
+        if call == 'Get':
+            counts['reads'] = len(request.key_list())
+        elif call in ('RunQuery', 'Next'):
+            counts['reads'] = len(response.result_list())
+        elif call == 'Put':
+            counts['writes'] = len(request.entity_list())
+        elif call == 'Delete':
+            counts['writes'] = len(request.key_list())
+        self._add(counts)
+
+    def memcache_hook(self, service, call, request, response):
+        self._add({'memcache_rpcs': 1})
+
+    def report(self):
+        header = ('endpoint', 'calls') + tuple(
+            'p{}_ms'.format(pct) for pct in PERCENTILES) + (
+            'max_ms', 'ds_rpcs', 'reads', 'writes', 'mc_rpcs')
+        rows = [header]
+        for name in sorted(self.latencies):
+            ordered = sorted(self.latencies[name])
+            calls = len(ordered)
+            counts = self.counts[name]
+            rows.append(
+                (name, str(calls)) +
+                tuple('{:.1f}'.format(_percentile(ordered, pct))
+                      for pct in PERCENTILES) +
+                ('{:.1f}'.format(ordered[-1]),) +
+                tuple('{:.2f}'.format(counts[key] / float(calls))
+                      for key in ('datastore_rpcs', 'reads', 'writes',
+                                  'memcache_rpcs')))
+        widths = [max(len(row[i]) for row in rows)
+                  for i in range(len(header))]
+        lines = ['  '.join(value.rjust(width) if i else value.ljust(width)
+                           for i, (value, width) in enumerate(zip(row,
+                                                                  widths)))
+                 for row in rows]
+        lines.insert(1, '-' * len(lines[0]))
+        return '\n'.join(lines)
+
+
+def setup_sdk(sdk_path):
+    if sdk_path:
+        sys.path.insert(0, os.path.expanduser(sdk_path))
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+
+
+def _activate_testbed():
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    # endpoints.api_server reads the minor version from CURRENT_VERSION_ID
+    bed.setup_env(current_version_id='benchmark.1', overwrite=True)
+    bed.activate()
+    # every write is visible to queries straight away, as after the
+    # high-replication datastore has caught up
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=os.path.dirname(
+        os.path.abspath(__file__)))
+    bed.init_app_identity_stub()
+    return bed
+
+
+def _install_hooks(recorder):
+    from google.appengine.api import apiproxy_stub_map
+    hooks = apiproxy_stub_map.apiproxy.GetPostCallHooks()
+    hooks.Append('benchmark_datastore', recorder.datastore_hook,
+                 'datastore_v3')
+    hooks.Append('benchmark_memcache', recorder.memcache_hook, 'memcache')
+
+
+class Player(object):
+    '''Drives one game through the API'''
+    def __init__(self, recorder, api, names, grid_size, rng):
+        self.recorder = recorder
+        self.api = api
+        self.names = names
+        self.grid_size = grid_size
+        self.rng = rng
+
+    def _call(self, endpoint, **fields):
+        from google.appengine.ext import ndb
+
+        # a fresh ndb context per call, as every request gets in production,
+        # so reads are not served from entities cached by earlier calls
+        ndb.set_context(ndb.make_default_context())
+        method = getattr(self.api, endpoint)
+        request = method.remote.request_type(**fields)
+        return self.recorder.call(endpoint, method, request)
+
+    def play(self):
+        from engine import COMPUTER_NAME
+
+        for name in self.names:
+            if name != COMPUTER_NAME:
+                self._call('create_user', name=name)
+        game = self._call('new_game', p1_username=self.names[0],
+                          p2_username=self.names[1],
+                          grid_size=self.grid_size)
+        game_key = game.urlsafe_key
+        humans = [name for name in self.names if name != COMPUTER_NAME]
+        for name in humans:
+            self._call('insert_fleet', player_name=name,
+                       urlsafe_game_key=game_key)
+
+        # each human fires at the opponent's cells in a random order
+        targets = {}
+        for name in humans:
+            cells = [(x, y) for x in range(1, self.grid_size + 1)
+                     for y in range(1, self.grid_size + 1)]
+            self.rng.shuffle(cells)
+            targets[name] = cells
+
+        turn = 0
+        while True:
+            name = humans[turn % len(humans)]
+            x, y = targets[name].pop()
+            board = self._call('make_guess', urlsafe_game_key=game_key,
+                               player_name=name, guess_x=x, guess_y=y)
+            turn += 1
+            # a human win sinks the last ship, a computer win is reported
+            # as the result of its reply
+            if board.remaining == 0 or board.message.endswith(': Win'):
+                break
+        self._call('get_game_history', urlsafe_game_key=game_key)
+        return turn
+
+
+def run(games, concurrency, grid_size, computer, seed):
+    '''Plays games with concurrency worker threads, returning the
+    Recorder'''
+    from api import BattleshipApi
+    from engine import COMPUTER_NAME
+
+    recorder = Recorder()
+    _install_hooks(recorder)
+    pending = list(range(games))
+    lock = threading.Lock()
+    errors = []
+
+    def worker(number):
+        api = BattleshipApi()
+        rng = random.Random('{}-{}'.format(seed, number))
+        while True:
+            with lock:
+                if not pending:
+                    return
+                index = pending.pop()
+            names = ['bench-{}-a'.format(index),
+                     COMPUTER_NAME if computer
+                     else 'bench-{}-b'.format(index)]
+            try:
+                Player(recorder, api, names, grid_size, rng).play()
+            except Exception as e:
+                errors.append(e)
+                return
+
+    threads = [threading.Thread(target=worker, args=(number,))
+               for number in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return recorder
+
+
+def _import_seconds(module, sdk_path):
+    '''Seconds a fresh interpreter takes to import module'''
+    root = os.path.dirname(os.path.abspath(__file__))
+    script = _IMPORT_TIMER.format(root=root, sdk=sdk_path, module=module)
+    output = subprocess.check_output([sys.executable, '-c', script],
+                                     cwd=root)
+    return float(output.strip().splitlines()[-1])
+
+
+def _warmup_seconds():
+    '''Seconds taken by the first and second warmup requests of an
+    instance, the first including the import of main'''
+    import webob
+
+    bed = _activate_testbed()
+    try:
+        start = time.time()
+        import main
+        timings = []
+        for _ in range(2):
+            response = webob.Request.blank('/_ah/warmup').get_response(
+                main.app)
+            if response.status_int >= 400:
+                raise RuntimeError('Warmup failed: ' + response.status)
+            timings.append(time.time() - start)
+            start = time.time()
+        return timings
+    finally:
+        bed.deactivate()
+
+
+def startup(sdk_path, runs):
+    '''Returns a report of import and warmup times'''
+    lines = ['{:<16}{:>10}{:>10}'.format('import', 'p50 ms', 'max ms')]
+    for module in STARTUP_MODULES:
+        timings = sorted(_import_seconds(module, sdk_path) * 1000
+                         for _ in range(runs))
+        lines.append('{:<16}{:>10.0f}{:>10.0f}'.format(
+            module, _percentile(timings, 50), timings[-1]))
+    first, second = _warmup_seconds()
+    lines.append('\nwarmup request: {:.0f}ms on a new instance (including '
+                 'the import of main), {:.0f}ms after that'.format(
+                     first * 1000, second * 1000))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', help='path to the App Engine SDK')
+    parser.add_argument('--games', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--grid-size', type=int, default=10)
+    parser.add_argument('--computer', action='store_true',
+                        help='play every game against the computer')
+    parser.add_argument('--seed', default='battleship')
+    parser.add_argument('--startup', action='store_true',
+                        help='measure import and warmup times instead')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='fresh interpreters per module with --startup')
+    args = parser.parse_args(argv)
+
+    setup_sdk(args.sdk)
+    if args.startup:
+        print(startup(args.sdk, args.runs))
+        return
+    bed = _activate_testbed()
+    try:
+        start = time.time()
+        recorder = run(args.games, args.concurrency, args.grid_size,
+                       args.computer, args.seed)
+        elapsed = time.time() - start
+    finally:
+        bed.deactivate()
+    print(recorder.report())
+    print('\n{} games in {:.1f}s with {} threads'.format(
+        args.games, elapsed, args.concurrency))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""counter.py - Sharded counters with a memcache front.
+
+Writes go to one of NUM_SHARDS randomly chosen shard entities so concurrent
+updates rarely contend. Reads are served from memcache and fall back to a
+single get_multi over the shards."""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+NUM_SHARDS = 20
+ACTIVE_GAMES = 'active_games'
+
+
+class CounterShard(ndb.Model):
+    '''One shard of a named counter'''
+    count = ndb.IntegerProperty(required=True, default=0, indexed=False)
+
+
+def _shard_keys(name):
+    return [ndb.Key(CounterShard, '{}-{}'.format(name, i))
+            for i in range(NUM_SHARDS)]
+
+
+def _cache_key(name):
+    return 'counter:{}'.format(name)
+
+
+def _update_cache(name, delta):
+    if delta >= 0:
+        memcache.incr(_cache_key(name), delta)
+    else:
+        memcache.decr(_cache_key(name), -delta)
+
+
+@ndb.transactional_tasklet(xg=True)
+def increment_async(name, delta=1):
+    '''Adds delta to a counter. Joins the caller's transaction if there is
+    one; memcache is only updated once that transaction commits'''
+    key = random.choice(_shard_keys(name))
+    shard = (yield key.get_async()) or CounterShard(key=key)
+    shard.count += delta
+    yield shard.put_async()
+    ndb.get_context().call_on_commit(lambda: _update_cache(name, delta))
+
+
+def get_count(name):
+    '''Returns the current value of a counter'''
+    count = memcache.get(_cache_key(name))
+    if count is None:
+        count = sum(shard.count for shard in
+                    ndb.get_multi(_shard_keys(name)) if shard)
+        memcache.add(_cache_key(name), count)
+    return count
+
+
+def cache_active_games():
+    '''Caches a message with the number of active games'''
+    count = get_count(ACTIVE_GAMES)
+    memcache.set('ACTIVE_GAMES',
+                 'There are {} game in play right now.'.format(count))
+
+
+@ndb.transactional(xg=True)
+def set_count(name, count):
+    '''Overwrites a counter, e.g. after reconciling it against the
+    datastore'''
+    shards = []
+    for i, key in enumerate(_shard_keys(name)):
+        shards.append(CounterShard(key=key, count=count if i == 0 else 0))
+    ndb.put_multi(shards)
+    ndb.get_context().call_on_commit(
+        lambda: memcache.set(_cache_key(name), count))
@@ -0,0 +1,375 @@
+"""engine.py - Battleship rules, independent of App Engine.
+
+GameEngine holds every rule of the game: who may move, bounds, hits,
+misses and wins, ship placement and the computer's replies. It works on
+plain GameState/BoardState objects and leaves loading and saving them to a
+Storage backend. storage.NdbStorage backs the endpoints; MemoryStorage
+below keeps everything in dicts, for simulations that run without the
+App Engine stack."""
+
+import itertools
+import random
+
+import fleet
+from grid import (
+    DEFAULT_GRID_SIZE,
+    MAX_GRID_SIZE,
+    MIN_GRID_SIZE,
+    cell,
+    in_bounds,
+    ship_cells)
+
+COMPUTER_NAME = 'computer'
+CANCELED = 'CANCELED'
+
+
+class GameError(Exception):
+    '''Base class for requests the engine refuses'''
+
+
+class NotFound(GameError):
+    pass
+
+
+class InvalidRequest(GameError):
+    pass
+
+
+class GameState(object):
+    '''Players, turn and result of one game. Players are user names.
+    version goes up by one with every change to the game or its boards'''
+    def __init__(self, player_1, player_2, grid_size=DEFAULT_GRID_SIZE,
+                 key=None, next_player=None, game_over=False, winner=None,
+                 last_move=0, version=0):
+        self.key = key
+        self.version = version
+        self.player_1 = player_1
+        self.player_2 = player_2
+        self.grid_size = grid_size
+        self.next_player = next_player or player_1
+        self.game_over = game_over
+        self.winner = winner
+        self.last_move = last_move
+
+    def slot_of(self, player_name):
+        '''Returns 1 or 2 for the player's seat in this game, or None'''
+        if player_name == self.player_1:
+            return 1
+        if player_name == self.player_2:
+            return 2
+        return None
+
+    def opponent_of(self, player_name):
+        if player_name == self.player_1:
+            return self.player_2
+        return self.player_1
+
+
+class BoardState(object):
+    '''One player's board as sets of cell indices'''
+    def __init__(self, player, grid_size=DEFAULT_GRID_SIZE, ships=None,
+                 hits=None, misses=None):
+        self.player = player
+        self.grid_size = grid_size
+        self.ships = set(ships or ())
+        self.hits = set(hits or ())
+        self.misses = set(misses or ())
+
+    @property
+    def remaining(self):
+        return len(self.ships - self.hits)
+
+
+class MoveRecord(object):
+    '''A single guess, numbered from 1 within its game'''
+    def __init__(self, number, player_name, x, y, result):
+        self.number = number
+        self.player_name = player_name
+        self.x = x
+        self.y = y
+        self.result = result
+
+
+class Outcome(object):
+    '''What an update did. board is the board to report back to the
+    caller; boards and moves are what changed and must be stored; ended is
+    True if this update finished the game; version is the game's version
+    after the update'''
+    def __init__(self, board, message, boards=(), moves=(), ended=False):
+        self.board = board
+        self.message = message
+        self.boards = list(boards)
+        self.moves = list(moves)
+        self.ended = ended
+        self.version = None
+
+    @property
+    def changed(self):
+        return bool(self.boards) or self.ended
+
+
+class Storage(object):
+    '''Where the engine keeps games. Backends implement:'''
+    def create_game(self, game, boards):
+        '''Stores a new game and its two boards, setting game.key. Raises
+        InvalidRequest if the players already have an active game'''
+        raise NotImplementedError
+
+    def create_games(self, games, boards):
+        '''Stores many new games at once; boards holds the two boards of
+        each game. Raises InvalidRequest, creating none of them, if any
+        pair of players already has an active game'''
+        raise NotImplementedError
+
+    def update_game(self, game_key, apply):
+        '''Loads (game, board_1, board_2), calls apply on them to get an
+        Outcome and, if it changed anything, stores the game with the
+        Outcome's boards and moves. Must be atomic: concurrent updates of
+        one game may not both be applied to the same state. Raises NotFound
+        if there is no such game'''
+        raise NotImplementedError
+
+    def get_version(self, game_key):
+        '''Returns (version, next_player) of a game, or None if there is no
+        such game, without loading its boards'''
+        raise NotImplementedError
+
+
+class MemoryStorage(Storage):
+    '''Keeps games in process memory. Not thread safe'''
+    def __init__(self):
+        self.games = {}
+        self.moves = {}
+        self.pairings = {}
+        self.stats = {}
+        self._ids = itertools.count(1)
+
+    def create_game(self, game, boards):
+        return self.create_games([game], [boards])[0]
+
+    def create_games(self, games, boards):
+        pairs = [tuple(sorted([game.player_1, game.player_2]))
+                 for game in games]
+        if any(pair in self.pairings for pair in pairs):
+            raise InvalidRequest('These players already have an active game!')
+        for game, pair, game_boards in zip(games, pairs, boards):
+            game.key = next(self._ids)
+            self.games[game.key] = (game, game_boards[0], game_boards[1])
+            self.moves[game.key] = []
+            self.pairings[pair] = game.key
+        return games
+
+    def update_game(self, game_key, apply):
+        if game_key not in self.games:
+            raise NotFound('Game not found!')
+        game, board_1, board_2 = self.games[game_key]
+        outcome = apply(game, board_1, board_2)
+        self.moves[game_key].extend(outcome.moves)
+        if outcome.ended:
+            del self.pairings[tuple(sorted([game.player_1, game.player_2]))]
+            if game.winner != CANCELED:
+                for name in (game.player_1, game.player_2):
+                    played, won = self.stats.get(name, (0, 0))
+                    self.stats[name] = (played + 1,
+                                        won + (name == game.winner))
+        return outcome
+
+    def get_version(self, game_key):
+        if game_key not in self.games:
+            return None
+        game = self.games[game_key][0]
+        return game.version, game.next_player
+
+
+class GameEngine(object):
+    '''Battleship rules over a Storage backend'''
+    def __init__(self, storage, rng=random):
+        self.storage = storage
+        self.rng = rng
+
+    def new_game(self, p1_name, p2_name, grid_size=DEFAULT_GRID_SIZE):
+        '''Creates a game. A p2 named COMPUTER_NAME gets a random fleet
+        and replies to every guess automatically'''
+        game, boards = self._build_game(p1_name, p2_name, grid_size)
+        return self.storage.create_game(game, boards)
+
+    def new_games(self, pairs, grid_size=DEFAULT_GRID_SIZE):
+        '''Creates a game for each (p1_name, p2_name) pair with a single
+        storage call'''
+        games = []
+        boards = []
+        for p1_name, p2_name in pairs:
+            game, game_boards = self._build_game(p1_name, p2_name,
+                                                 grid_size)
+            games.append(game)
+            boards.append(game_boards)
+        return self.storage.create_games(games, boards)
+
+    def _build_game(self, p1_name, p2_name, grid_size):
+        if not MIN_GRID_SIZE <= grid_size <= MAX_GRID_SIZE:
+            raise InvalidRequest(
+                'Grid size must be between {} and {}'.format(MIN_GRID_SIZE,
+                                                             MAX_GRID_SIZE))
+        if p1_name == COMPUTER_NAME:
+            raise InvalidRequest('The computer can only play as p2!')
+        game = GameState(p1_name, p2_name, grid_size)
+        boards = [BoardState(p1_name, grid_size),
+                  BoardState(p2_name, grid_size)]
+        if p2_name == COMPUTER_NAME:
+            boards[1].ships, _ = fleet.random_fleet(size=grid_size,
+                                                    rng=self.rng)
+        return game, boards
+
+    def cancel(self, game_key):
+        '''Ends a game before it has been won'''
+        def apply(game, board_1, board_2):
+            # validate game is still in play before canceling
+            if game.game_over:
+                raise InvalidRequest('Game is already over!')
+            game.game_over = True
+            game.winner = CANCELED
+            return Outcome(None, 'Game canceled', [], [], ended=True)
+        return self._update(game_key, apply)
+
+    def place_ship(self, game_key, player_name, x, y, length, horizontal):
+        '''Adds one ship to the player's board'''
+        def apply(game, board_1, board_2):
+            board = self._own_board(game, board_1, board_2, player_name)
+            # checks that all coordinates are on the board
+            new_ship = ship_cells(x, y, length, horizontal, board.grid_size)
+            if new_ship is None:
+                return Outcome(board, 'That ship goes off the board. \
+                                     Try again!')
+
+            # checks for overlap with existing ships
+            if new_ship & board.ships:
+                return Outcome(board, 'That ship overlaps another. \
+                                 Try again!')
+
+            board.ships |= new_ship
+            return Outcome(board, 'Ship added successfully!', [board])
+        return self._update(game_key, apply)
+
+    def place_fleet(self, game_key, player_name, ships=None):
+        '''Places a player's whole fleet of (x, y, length, horizontal)
+        ships, replacing any already placed. Without ships, places the
+        standard fleet at random'''
+        def apply(game, board_1, board_2):
+            board = self._own_board(game, board_1, board_2, player_name)
+            if board.hits or board.misses:
+                return Outcome(board, 'Ships cannot be moved once play has \
+                                 started!')
+
+            if ships:
+                cells, error = fleet.fleet_mask(ships, board.grid_size)
+                if error:
+                    return Outcome(board, '{} Try again!'.format(error))
+            else:
+                cells, _ = fleet.random_fleet(size=board.grid_size,
+                                              rng=self.rng)
+
+            board.ships = set(cells)
+            return Outcome(board, 'Fleet placed successfully!', [board])
+        return self._update(game_key, apply)
+
+    def guess(self, game_key, player_name, x, y):
+        '''Plays a player's guess and, when the opponent is the computer,
+        the computer's reply. The Outcome's board is the opponent's'''
+        def apply(game, board_1, board_2):
+            return self._apply_turn(game, board_1, board_2, player_name,
+                                    [x, y])
+        return self._update(game_key, apply)
+
+    def _update(self, game_key, apply):
+        '''Runs an update through the storage backend, counting every
+        change in the game's version'''
+        def versioned(game, board_1, board_2):
+            outcome = apply(game, board_1, board_2)
+            if outcome.changed:
+                game.version += 1
+            outcome.version = game.version
+            return outcome
+        return self.storage.update_game(game_key, versioned)
+
+    @staticmethod
+    def _own_board(game, board_1, board_2, player_name):
+        slot = game.slot_of(player_name)
+        if not slot:
+            raise NotFound('Board not found.')
+        return board_1 if slot == 1 else board_2
+
+    def _apply_turn(self, game, board_1, board_2, player_name, guess_coord):
+        outcome = self._apply_guess(game, board_1, board_2, player_name,
+                                    guess_coord)
+        if (not outcome.changed or game.game_over or
+                game.next_player != COMPUTER_NAME):
+            return outcome
+
+        # the computer fires back at the player's own board
+        import ai
+        board = outcome.board
+        player_board = board_2 if board is board_1 else board_1
+        target = ai.choose_target(game.grid_size, player_board.hits,
+                                  player_board.misses, self.rng)
+        reply = self._apply_guess(game, board_1, board_2, COMPUTER_NAME,
+                                  target)
+        message = '{} The computer fired at {}/{}: {}'.format(
+            outcome.message, target[0], target[1], reply.moves[0].result)
+        return Outcome(board, message, [board_1, board_2],
+                       outcome.moves + reply.moves, ended=reply.ended)
+
+    @staticmethod
+    def _apply_guess(game, board_1, board_2, player_name, guess_coord):
+        slot = game.slot_of(player_name)
+        if not slot:
+            raise InvalidRequest('Player is not in this game!')
+
+        # guesses land on the opponent's board
+        board = board_2 if slot == 1 else board_1
+
+        if player_name != game.next_player:
+            return Outcome(board, "It's not your turn yet!")
+
+        if game.game_over:
+            winner = game.winner
+            return Outcome(board, 'Game already over,'
+                                  '{} won!'.format(winner))
+
+        # verifies guess is within board
+        if not in_bounds(guess_coord[0], guess_coord[1], game.grid_size):
+            raise InvalidRequest('Guess outside of board range')
+
+        guess = cell(guess_coord[0], guess_coord[1], game.grid_size)
+
+        # checks if the guess has already been entered
+        if guess in board.hits or guess in board.misses:
+            return Outcome(board, "You've already guessed"
+                                  "those coordinates!")
+
+        ended = False
+        # if guess is novel, checks for a hit
+        if guess in board.ships:
+            board.hits.add(guess)
+
+            # in a hit, checks if all ship cells are hit, announces win if so
+            if len(board.hits) == len(board.ships):
+                game.game_over = True
+                game.winner = player_name
+                message = 'Congrats, you won!'
+                result = 'Win'
+                ended = True
+            else:
+                # if not the final hit, notifies user
+                message = 'A hit! Keep going!'
+                result = 'Hit'
+        else:
+            board.misses.add(guess)
+            message = 'Sorry, you missed!'
+            result = 'Miss'
+
+        if not ended:
+            game.next_player = game.opponent_of(player_name)
+        game.last_move += 1
+        move = MoveRecord(game.last_move, player_name, guess_coord[0],
+                          guess_coord[1], result)
+        return Outcome(board, message, [board], [move], ended=ended)
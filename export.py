@@ -0,0 +1,147 @@
+"""export.py - Offline export of finished games for analytics.
+
+Pages through ArchivedGames and through finished Games that have not been
+archived yet, with query cursors, and streams them to a packed binary
+file (see analytics.py for the format). Each page is written out and
+dropped from ndb's cache before the next is fetched, so memory use is
+bounded by the page size rather than the number of games.
+
+It runs against a local datastore file through the SDK's datastore stub,
+for example a copy of the development server's datastore or one restored
+from a backup:
+
+    python export.py --sdk ~/google_appengine \\
+        --datastore-path /tmp/battleship.db --output games.bin --aggregate
+"""
+
+import argparse
+
+from benchmark import setup_sdk
+
+EXPORT_BATCH_SIZE = 100
+DEFAULT_APP_ID = 'dev~battleship-1344'
+
+
+def _activate_stubs(datastore_path, app_id):
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.setup_env(app_id=app_id, overwrite=True)
+    bed.activate()
+    bed.init_datastore_v3_stub(datastore_file=datastore_path,
+                               use_sqlite=True,
+                               require_indexes=False)
+    bed.init_memcache_stub()
+    return bed
+
+
+def _pages(query, batch_size):
+    '''Yields the results of a query one page at a time'''
+    from google.appengine.ext import ndb
+    from utils import fetch_page
+
+    cursor = None
+    while True:
+        results, cursor = fetch_page(query, batch_size, cursor)
+        yield results
+        ndb.get_context().clear_cache()
+        if not cursor:
+            return
+
+
+def _archived_records(batch_size):
+    import analytics
+    from models import ArchivedGame
+
+    for archives in _pages(ArchivedGame.query(), batch_size):
+        for archive in archives:
+            data = archive.data
+            players = (data['player_1'], data['player_2'])
+            boards = {}
+            for board in data['boards']:
+                boards[board['player']] = (board['ships'], board['hits'],
+                                           board['misses'])
+            if len(boards) != 2:
+                continue
+            yield analytics.pack_game(data['grid_size'], players,
+                                      data['winner'],
+                                      [boards[name] for name in players],
+                                      data['moves'])
+
+
+def _game_records(batch_size):
+    import analytics
+    from google.appengine.ext import ndb
+    from models import Game
+
+    query = Game.query(Game.game_over == True)
+    for games in _pages(query, batch_size):
+        boards = ndb.get_multi([key for game in games
+                                for key in game.board_keys()])
+        names = Game.user_names([key for game in games
+                                 for key in game.player_keys()])
+        for number, game in enumerate(games):
+            board_1, board_2 = boards[2 * number:2 * number + 2]
+            if not board_1 or not board_2:
+                continue
+            yield analytics.pack_game(game.grid_size,
+                                      (names[game.player_1],
+                                       names[game.player_2]),
+                                      game.winner,
+                                      [board_1.get_layers(),
+                                       board_2.get_layers()],
+                                      game.get_moves())
+
+
+def export(output_path, batch_size=EXPORT_BATCH_SIZE):
+    '''Writes every finished game to output_path, returning the number of
+    games written'''
+    import analytics
+
+    count = 0
+    with open(output_path, 'wb') as output:
+        output.write(analytics.file_header())
+        for records in (_archived_records(batch_size),
+                        _game_records(batch_size)):
+            for record in records:
+                output.write(record)
+                count += 1
+    return count
+
+
+def _summarize(path):
+    import analytics
+
+    for size, stats in sorted(analytics.cell_frequencies(path).items()):
+        hot = stats['ship_rate'].argmax()
+        print('{0}x{0}: {1} games, {2:.1f} winning shots per game, '
+              '{3:.0%} accuracy, ships most often at {4}/{5}'.format(
+                  size, stats['games'], stats['shots_to_win'],
+                  stats['accuracy'], hot % size + 1, hot // size + 1))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', help='path to the App Engine SDK')
+    parser.add_argument('--datastore-path', required=True,
+                        help='local datastore file to read')
+    parser.add_argument('--app-id', default=DEFAULT_APP_ID)
+    parser.add_argument('--output', default='games.bin')
+    parser.add_argument('--batch-size', type=int, default=EXPORT_BATCH_SIZE)
+    parser.add_argument('--aggregate', action='store_true',
+                        help='print per-grid cell frequency summaries')
+    args = parser.parse_args(argv)
+
+    setup_sdk(args.sdk)
+    bed = _activate_stubs(args.datastore_path, args.app_id)
+    try:
+        count = export(args.output, args.batch_size)
+    finally:
+        bed.deactivate()
+    print('Exported {} games to {}'.format(count, args.output))
+    if args.aggregate:
+        _summarize(args.output)
+
+
+if __name__ == '__main__':
+    main()
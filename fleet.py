@@ -0,0 +1,56 @@
+"""fleet.py - Whole-fleet validation and random fleet layouts.
+
+Ships are handled as sets of cell indices (see grid.py), so checking a
+fleet for overlaps is one intersection per ship against the cells occupied
+so far, and placing a fleet costs the same on any grid size."""
+
+import random
+
+from grid import DEFAULT_GRID_SIZE, ship_cells
+
+FLEET = (5, 4, 3, 3, 2)
+MAX_ATTEMPTS = 100
+
+
+def fleet_mask(ships, size=DEFAULT_GRID_SIZE):
+    '''Validates a fleet of (x, y, length, horizontal) ships.
+    Returns (cells, error): the cells occupied by the whole fleet and None,
+    or None and a message naming the first ship that is off the board or
+    overlaps another'''
+    occupied = set()
+    for number, ship in enumerate(ships, 1):
+        cells = ship_cells(*ship, size=size)
+        if cells is None:
+            return None, 'Ship {} goes off the board.'.format(number)
+        if cells & occupied:
+            return None, 'Ship {} overlaps another.'.format(number)
+        occupied |= cells
+    return occupied, None
+
+
+def random_fleet(lengths=FLEET, size=DEFAULT_GRID_SIZE, rng=random):
+    '''Returns (cells, ships) for a random legal layout of ships with the
+    given lengths, placing the longest ships first'''
+    lengths = sorted(lengths, reverse=True)
+    for _ in range(MAX_ATTEMPTS):
+        occupied = set()
+        ships = []
+        for length in lengths:
+            for _ in range(MAX_ATTEMPTS):
+                horizontal = rng.random() < 0.5
+                if horizontal:
+                    x = rng.randint(1, size - length + 1)
+                    y = rng.randint(1, size)
+                else:
+                    x = rng.randint(1, size)
+                    y = rng.randint(1, size - length + 1)
+                cells = ship_cells(x, y, length, horizontal, size)
+                if not cells & occupied:
+                    break
+            else:
+                break
+            occupied |= cells
+            ships.append((x, y, length, horizontal))
+        else:
+            return occupied, ships
+    raise ValueError('No room for a fleet of {}'.format(lengths))
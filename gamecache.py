@@ -0,0 +1,148 @@
+"""gamecache.py - Memcache snapshots of in-progress games.
+
+A snapshot holds a Game and both of its Boards, encoded as entity protocol
+buffers. Player names need no caching since Users are keyed by name.
+
+Updates (turns, ship placement, cancellation) are played against the
+snapshot and written to the datastore, which only accepts the write if
+the game is still at the version the snapshot was read at; the new
+snapshot is then published with compare-and-set. A snapshot therefore
+only ever holds a committed state, though possibly an old one. A
+snapshot is evicted when the game ends.
+
+Each game's version number and next player are cached separately, and so
+is a version of the list of active games that changes whenever any game
+does, so polling clients can be told nothing changed with one memcache
+get."""
+
+import time
+
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+
+SNAPSHOT_SECONDS = 60 * 60
+VERSION_ATTEMPTS = 3
+LIST_VERSION_KEY = 'active_games_version'
+
+
+def _cache_key(urlsafe_game_key):
+    return 'live_game:{}'.format(urlsafe_game_key)
+
+
+def _encode(entities):
+    return [entity._to_pb().Encode() for entity in entities]
+
+
+def _decode(encoded):
+    adapter = ndb.ModelAdapter()
+    return [adapter.pb_to_entity(entity_pb.EntityProto(pb))
+            for pb in encoded]
+
+
+class LiveGame(object):
+    '''The cached snapshot of one game. load() and save() must be called on
+    the same instance so save() can compare-and-set against what load()
+    read'''
+    def __init__(self, urlsafe_game_key):
+        self.cache_key = _cache_key(urlsafe_game_key)
+        self._client = memcache.Client()
+        self._loaded = False
+
+    def load(self):
+        '''Returns (game, board_1, board_2), or None if not cached'''
+        encoded = self._client.gets(self.cache_key)
+        if encoded is None:
+            return None
+        self._loaded = True
+        return tuple(_decode(encoded))
+
+    def save(self, game, board_1, board_2):
+        '''Stores a snapshot. After load() this is a compare-and-set that
+        returns False if another request changed the snapshot first;
+        otherwise it only adds a snapshot if none exists'''
+        encoded = _encode([game, board_1, board_2])
+        if self._loaded:
+            return self._client.cas(self.cache_key, encoded,
+                                    time=SNAPSHOT_SECONDS)
+        return self._client.add(self.cache_key, encoded,
+                                time=SNAPSHOT_SECONDS)
+
+
+def refresh(urlsafe_game_key, game, board_1, board_2):
+    '''Caches a snapshot read from the datastore unless the same or a later
+    version of the game is already cached, so a slow request can't roll
+    the snapshot back'''
+    for _ in range(VERSION_ATTEMPTS):
+        live = LiveGame(urlsafe_game_key)
+        cached = live.load()
+        if cached is not None and cached[0].version >= game.version:
+            return
+        if live.save(game, board_1, board_2):
+            return
+    evict(urlsafe_game_key)
+
+
+def evict(urlsafe_game_key):
+    memcache.delete(_cache_key(urlsafe_game_key))
+
+
+def _version_key(urlsafe_game_key):
+    return 'game_version:{}'.format(urlsafe_game_key)
+
+
+def forget(urlsafe_game_key):
+    '''Drops a game's snapshot and version, once the game no longer
+    exists'''
+    memcache.delete_multi([_cache_key(urlsafe_game_key),
+                           _version_key(urlsafe_game_key)])
+
+
+def get_version(urlsafe_game_key):
+    '''Returns the cached (version, next_player) of a game, or None'''
+    return memcache.get(_version_key(urlsafe_game_key))
+
+
+def set_version(urlsafe_game_key, version, next_player):
+    '''Caches a game's version unless a later one is already cached, so
+    writes that finish out of order can't roll it back'''
+    client = memcache.Client()
+    key = _version_key(urlsafe_game_key)
+    value = (version, next_player)
+    for _ in range(VERSION_ATTEMPTS):
+        cached = client.gets(key)
+        if cached is None:
+            if client.add(key, value, time=SNAPSHOT_SECONDS):
+                return
+        elif cached[0] >= version:
+            return
+        elif client.cas(key, value, time=SNAPSHOT_SECONDS):
+            return
+    client.delete(key)
+
+
+def add_versions(versions):
+    '''Caches the versions of newly created games, given as a dict of
+    urlsafe game key to (version, next_player)'''
+    memcache.add_multi(dict((_version_key(key), value)
+                            for key, value in versions.items()),
+                       time=SNAPSHOT_SECONDS)
+
+
+def _list_version_seed():
+    # a version restarted after an eviction starts from the clock, so it
+    # can't repeat a version handed out before
+    return int(time.time() * 1000000)
+
+
+def get_list_version():
+    '''Returns the version of the list of active games'''
+    version = memcache.get(LIST_VERSION_KEY)
+    if version is None:
+        memcache.add(LIST_VERSION_KEY, _list_version_seed())
+        version = memcache.get(LIST_VERSION_KEY)
+    return version
+
+
+def bump_list_version():
+    memcache.incr(LIST_VERSION_KEY, initial_value=_list_version_seed())
@@ -0,0 +1,99 @@
+"""grid.py - Sparse board layers.
+
+Each board layer (ships, hits, misses) is a set of cell indices, so its
+size and the cost of using it depend on how many cells are set rather than
+on the area of the grid. Cell x/y (both 1-based) on a grid of width size
+has index (y - 1) * size + (x - 1).
+
+Boards written before grid sizes were configurable hold 10x10 bitboards,
+one bit per cell with the same indexing; unpack_bitboards reads those."""
+
+import array
+import struct
+import sys
+
+DEFAULT_GRID_SIZE = 10
+MIN_GRID_SIZE = 8
+MAX_GRID_SIZE = 1000
+LEGACY_LAYER_BYTES = 13
+
+
+def in_bounds(x, y, size=DEFAULT_GRID_SIZE):
+    '''True if x/y is a cell on the board'''
+    return 1 <= x <= size and 1 <= y <= size
+
+
+def cell(x, y, size=DEFAULT_GRID_SIZE):
+    '''Returns the index of cell x/y'''
+    return (y - 1) * size + (x - 1)
+
+
+def layer_coords(layer, size=DEFAULT_GRID_SIZE):
+    '''Returns the [x, y] pairs set in a layer, in cell order'''
+    return [[index % size + 1, index // size + 1] for index in sorted(layer)]
+
+
+def coords_to_layer(coords, size=DEFAULT_GRID_SIZE):
+    '''Builds a layer from legacy "x_y" coordinate strings'''
+    layer = set()
+    for item in coords:
+        x, y = item.split('_')
+        layer.add(cell(int(x), int(y), size))
+    return layer
+
+
+def ship_cells(x, y, length, horizontal, size=DEFAULT_GRID_SIZE):
+    '''Returns the cells covered by a ship starting at x/y, or None if any
+    part of it is off the board'''
+    if length < 1 or not in_bounds(x, y, size):
+        return None
+    start = cell(x, y, size)
+    if horizontal:
+        if x + length - 1 > size:
+            return None
+        return frozenset(range(start, start + length))
+    if y + length - 1 > size:
+        return None
+    return frozenset(range(start, start + length * size, size))
+
+
+def _to_array(layer):
+    cells = array.array('I', sorted(layer))
+    if sys.byteorder == 'big':
+        cells.byteswap()
+    return cells
+
+
+def pack_layers(*layers):
+    '''Packs layers into one byte string: a little-endian uint32 count per
+    layer, followed by each layer's sorted cell indices as uint32s'''
+    header = struct.pack('<{}I'.format(len(layers)),
+                         *[len(layer) for layer in layers])
+    return header + ''.join(_to_array(layer).tostring() for layer in layers)
+
+
+def unpack_layers(blob, count=3):
+    '''Inverse of pack_layers, returns a tuple of count sets'''
+    header_size = struct.calcsize('<{}I'.format(count))
+    sizes = struct.unpack('<{}I'.format(count), blob[:header_size])
+    cells = array.array('I')
+    cells.fromstring(blob[header_size:])
+    if sys.byteorder == 'big':
+        cells.byteswap()
+    layers = []
+    offset = 0
+    for size in sizes:
+        layers.append(set(cells[offset:offset + size]))
+        offset += size
+    return tuple(layers)
+
+
+def unpack_bitboards(blob, count=3):
+    '''Reads legacy 10x10 bitboard layers into sets'''
+    layers = []
+    for i in range(count):
+        chunk = blob[i * LEGACY_LAYER_BYTES:(i + 1) * LEGACY_LAYER_BYTES]
+        bits = int(chunk.encode('hex'), 16) if chunk else 0
+        layers.append(set(index for index in range(bits.bit_length())
+                          if bits >> index & 1))
+    return tuple(layers)
@@ -0,0 +1,107 @@
+"""leaderboard.py - Player rankings by win percentage.
+
+Rank lookups use a histogram of how many users hold each win percentage
+(0-100). The histogram is split over NUM_SHARDS entities, updated in the
+same transaction as the users whose percentage changed, and cached in
+memcache once summed. A user's rank is one more than the number of users
+with a strictly higher percentage, so it never needs a scan of User.
+
+The top of the leaderboard is a plain indexed query, cached for
+TOP_CACHE_SECONDS."""
+
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+from models import User
+
+NUM_SHARDS = 20
+BUCKETS = 101
+TOP_K = 50
+TOP_CACHE_SECONDS = 60
+HISTOGRAM_CACHE_KEY = 'leaderboard:histogram'
+TOP_CACHE_KEY = 'leaderboard:top'
+
+
+class LeaderboardShard(ndb.Model):
+    '''Part of the count of users per win percentage'''
+    counts = ndb.IntegerProperty(repeated=True, indexed=False)
+
+
+def _shard_keys():
+    return [ndb.Key(LeaderboardShard, str(i)) for i in range(NUM_SHARDS)]
+
+
+@ndb.transactional_tasklet(xg=True)
+def record_changes_async(changes):
+    '''Moves users between histogram buckets. Joins the caller's
+    transaction, so call it alongside the put of the changed users.
+    Args:
+        changes: list of (old_pctg, new_pctg) pairs; old_pctg is None for a
+            newly created user'''
+    changes = [(old, new) for old, new in changes if old != new]
+    if not changes:
+        return
+    key = random.choice(_shard_keys())
+    shard = ((yield key.get_async()) or
+             LeaderboardShard(key=key, counts=[0] * BUCKETS))
+    for old, new in changes:
+        if old is not None:
+            shard.counts[old] -= 1
+        shard.counts[new] += 1
+    yield shard.put_async()
+    ndb.get_context().call_on_commit(
+        lambda: memcache.delete(HISTOGRAM_CACHE_KEY))
+
+
+def record_changes(changes):
+    record_changes_async(changes).get_result()
+
+
+@ndb.tasklet
+def get_histogram_async():
+    '''Returns the number of users holding each win percentage'''
+    context = ndb.get_context()
+    histogram = yield context.memcache_get(HISTOGRAM_CACHE_KEY)
+    if histogram is None:
+        histogram = [0] * BUCKETS
+        for shard in (yield ndb.get_multi_async(_shard_keys())):
+            if shard:
+                histogram = [a + b for a, b in zip(histogram, shard.counts)]
+        yield context.memcache_add(HISTOGRAM_CACHE_KEY, histogram)
+    raise ndb.Return(histogram)
+
+
+def get_histogram():
+    return get_histogram_async().get_result()
+
+
+def get_rank(win_pctg, histogram=None):
+    '''Returns the 1-based rank of a user with this win percentage'''
+    if histogram is None:
+        histogram = get_histogram()
+    return 1 + sum(histogram[win_pctg + 1:])
+
+
+def get_top():
+    '''Returns the TOP_K best players as (users, next_cursor)'''
+    top = memcache.get(TOP_CACHE_KEY)
+    if top is None:
+        users, cursor, more = User.query().order(-User.win_pctg).fetch_page(
+            TOP_K)
+        top = (users, cursor.urlsafe() if more and cursor else None)
+        memcache.set(TOP_CACHE_KEY, top, time=TOP_CACHE_SECONDS)
+    return top
+
+
+@ndb.transactional(xg=True)
+def set_histogram(histogram):
+    '''Overwrites the histogram, e.g. after a full rebuild'''
+    shards = []
+    for i, key in enumerate(_shard_keys()):
+        counts = histogram if i == 0 else [0] * BUCKETS
+        shards.append(LeaderboardShard(key=key, counts=counts))
+    ndb.put_multi(shards)
+    ndb.get_context().call_on_commit(
+        lambda: memcache.delete_multi([HISTOGRAM_CACHE_KEY, TOP_CACHE_KEY]))
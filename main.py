@@ -1,40 +1,523 @@
+import datetime
+import hashlib
+import importlib
+import json
+import logging
+
 import webapp2
-from google.appengine.api import mail, app_identity
-from api import BattleshipApi
+from google.appengine.api import mail, app_identity, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+import counter
+import gamecache
+import leaderboard
+import metrics
+
+from engine import CANCELED
+from models import (User, Game, Board, Move, ReminderSent, ActivePairing,
+                    ArchivedGame, StatsTally)
 
-from models import User, Game
+MIGRATION_BATCH_SIZE = 100
+REMINDER_BATCH_SIZE = 100
+ARCHIVE_BATCH_SIZE = 50
+# modules a new instance loads during warmup rather than on its first
+# request: the endpoints service and NumPy for the computer player
+WARMUP_MODULES = ('api', 'ai')
 
 
 class SendReminderEmail(webapp2.RequestHandler):
     def get(self):
-        '''Sends a reminder to users who are due to make a move'''
-        app_id = app_identity.get_application_id()
-        games = Game.query(Game.game_over == False).fetch()
-        next_users = []
+        '''Starts the reminder fan-out for today'''
+        taskqueue.add(url='/tasks/send_reminders',
+                      params={'date': datetime.date.today().isoformat()})
 
-        for game in games:
-            next_users.append(game.next_player)
 
-        for u_key in next_users:
-            user = u_key.get()
-            if user.email:
-                subject = "Your turn!"
-                body = "Hello {}, it's your turn to move \
-                    on Battleship!".format(user.user_name)
-                mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
-                               user.email,
-                               subject,
-                               body)
+class SendReminderBatch(webapp2.RequestHandler):
+    '''Sends reminders for one keys-only page of active games, then
+    enqueues the task for the next page. Tasks are named after the date
+    and cursor, so a retried page can't start a second copy of the chain'''
+    def post(self):
+        date = self.request.get('date')
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        game_keys, next_cursor, more = Game.query(
+            Game.game_over == False).fetch_page(REMINDER_BATCH_SIZE,
+                                                start_cursor=cursor,
+                                                keys_only=True)
+
+        user_keys = set(game.next_player for game in ndb.get_multi(game_keys)
+                        if game and game.next_player)
+        users = [user for user in ndb.get_multi(list(user_keys))
+                 if user and user.email]
+        # marked before sending, so a retry never emails anyone twice
+        unsent = set(ReminderSent.mark_multi(date,
+                                             [user.key for user in users]))
+
+        app_id = app_identity.get_application_id()
+        for user in users:
+            if user.key not in unsent:
+                continue
+            subject = "Your turn!"
+            body = "Hello {}, it's your turn to move \
+                on Battleship!".format(user.user_name)
+            mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
+                           user.email,
+                           subject,
+                           body)
+
+        if more and next_cursor:
+            next_page = next_cursor.urlsafe()
+            name = 'reminders-{}-{}'.format(
+                date, hashlib.sha1(next_page).hexdigest())
+            try:
+                taskqueue.add(url='/tasks/send_reminders',
+                              name=name,
+                              params={'date': date, 'cursor': next_page})
+            except (taskqueue.TaskAlreadyExistsError,
+                    taskqueue.TombstonedTaskError):
+                pass
+        self.response.set_status(204)
 
 
 class UpdateActiveGames(webapp2.RequestHandler):
     '''Updates count of active games'''
     def post(self):
-        BattleshipApi._cache_gameCount()
+        counter.cache_active_games()
+        self.response.set_status(204)
+
+
+class ReconcileActiveGames(webapp2.RequestHandler):
+    '''Resets the active game counter from a keys-only count, correcting any
+    drift between the counter and the datastore'''
+    def get(self):
+        count = Game.query(Game.game_over == False).count()
+        counter.set_count(counter.ACTIVE_GAMES, count)
+        counter.cache_active_games()
+
+
+@ndb.transactional_tasklet
+def _resave_user_async(user_key):
+    '''Re-puts a User so its computed properties are stored again. The
+    User is read in the transaction, so a concurrent stats update is
+    never overwritten'''
+    user = yield user_key.get_async()
+    if user:
+        yield user.put_async()
+
+
+class RebuildLeaderboard(webapp2.RequestHandler):
+    '''Rebuilds the leaderboard histogram. The first phase re-puts every
+    User, one batch per task, so stored win_pctg values are recomputed;
+    the second tallies win_pctg with a projection query.
+    The tally overwrites every shard, so games that end while it runs are
+    not counted in the rebuilt histogram: run it while the app is quiet'''
+    def post(self):
+        if self.request.get('phase') == 'histogram':
+            histogram = [0] * leaderboard.BUCKETS
+            for user in User.query(projection=[User.win_pctg]):
+                histogram[user.win_pctg] += 1
+            leaderboard.set_histogram(histogram)
+            self.response.set_status(204)
+            return
+
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        user_keys, next_cursor, more = User.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        for future in [_resave_user_async(key) for key in user_keys]:
+            future.get_result()
+
+        if more and next_cursor:
+            params = {'cursor': next_cursor.urlsafe()}
+        else:
+            params = {'phase': 'histogram'}
+        taskqueue.add(url='/tasks/rebuild_leaderboard', params=params)
+        self.response.set_status(204)
+
+
+class BackfillPairings(webapp2.RequestHandler):
+    '''Creates the ActivePairing index entry for every active game that was
+    started before the index existed, one batch per task. Pairings are
+    keyed by user name, so games still pointing at auto-id Users are
+    mapped to their names, and the task can run before, during or after
+    /tasks/migrate_keys. A game whose auto-id Users that task deleted
+    under it is logged and skipped; running the task again picks it up'''
+    def post(self):
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = Game.query(
+            Game.game_over == False).fetch_page(MIGRATION_BATCH_SIZE,
+                                                start_cursor=cursor)
+        names = Game.user_names([key for game in games
+                                 for key in (game.player_1, game.player_2)])
+        pairings = []
+        for game in games:
+            p1, p2 = names[game.player_1], names[game.player_2]
+            if not p1 or not p2:
+                logging.warning('Game %s has a missing player', game.key)
+                continue
+            pairings.append(ActivePairing(
+                key=ActivePairing.key_for(User.key_for(p1), User.key_for(p2)),
+                game=game.key))
+        ndb.put_multi(pairings)
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_pairings',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class MigrateBoards(webapp2.RequestHandler):
+    '''Rewrites legacy Boards as packed cell sets, one batch
+    per task, re-enqueueing itself with a cursor until all are done'''
+    def post(self):
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        boards, next_cursor, more = Board.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor)
+
+        stale = [board for board in boards if board.needs_migration()]
+        for board in stale:
+            board.set_layers(*board.get_layers())
+        ndb.put_multi(stale)
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_boards',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+
+class MigrateKeys(webapp2.RequestHandler):
+    '''Moves pre-existing data onto deterministic keys, one batch per task:
+    - users: copies auto-id Users to Users keyed by user_name
+    - games: repoints Game player keys at the new Users and moves each
+      game's Boards to player-1/player-2 children of the Game
+    - cleanup: deletes the auto-id Users
+    Each phase re-enqueues itself with a cursor, then starts the next.'''
+    PHASES = ['users', 'games', 'cleanup']
+
+    def post(self):
+        phase = self.request.get('phase') or self.PHASES[0]
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        model = Game if phase == 'games' else User
+        entities, next_cursor, more = model.query().fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor)
+
+        getattr(self, '_migrate_' + phase)(entities)
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_keys',
+                          params={'phase': phase,
+                                  'cursor': next_cursor.urlsafe()})
+        elif phase != self.PHASES[-1]:
+            next_phase = self.PHASES[self.PHASES.index(phase) + 1]
+            taskqueue.add(url='/tasks/migrate_keys',
+                          params={'phase': next_phase})
         self.response.set_status(204)
 
+    @staticmethod
+    def _is_legacy(key):
+        return isinstance(key.id(), (int, long))
+
+    def _migrate_users(self, users):
+        ndb.put_multi([User(key=User.key_for(user.user_name),
+                            user_name=user.user_name,
+                            email=user.email,
+                            games_played=user.games_played,
+                            games_won=user.games_won)
+                       for user in users if self._is_legacy(user.key)])
+
+    def _migrate_cleanup(self, users):
+        ndb.delete_multi([user.key for user in users
+                          if self._is_legacy(user.key)])
+
+    def _migrate_games(self, games):
+        legacy_keys = set()
+        for game in games:
+            for key in (game.player_1, game.player_2, game.next_player):
+                if key and self._is_legacy(key):
+                    legacy_keys.add(key)
+        legacy_keys = list(legacy_keys)
+        new_keys = {}
+        for key, user in zip(legacy_keys, ndb.get_multi(legacy_keys)):
+            if user:
+                new_keys[key] = User.key_for(user.user_name)
 
-app = webapp2.WSGIApplication([
+        puts = []
+        deletes = []
+        for game in games:
+            old_players = [game.player_1, game.player_2]
+            game.player_1 = new_keys.get(game.player_1, game.player_1)
+            game.player_2 = new_keys.get(game.player_2, game.player_2)
+            if game.next_player:
+                game.next_player = new_keys.get(game.next_player,
+                                                game.next_player)
+            puts.append(game)
+
+            g_key = game.key.urlsafe()
+            for board in Board.query(Board.urlsafe_game_key == g_key):
+                if board.key.parent() is not None:
+                    continue
+                slot = old_players.index(board.player) + 1
+                deletes.append(board.key)
+                board.key = Board.key_for(game.key, slot)
+                board.player = new_keys.get(board.player, board.player)
+                board.opponent = new_keys.get(board.opponent, board.opponent)
+                puts.append(board)
+
+        ndb.put_multi(puts)
+        ndb.delete_multi(deletes)
+
+
+class ArchiveFinishedGames(webapp2.RequestHandler):
+    def get(self):
+        '''Starts archiving finished games'''
+        taskqueue.add(url='/tasks/archive_games')
+
+
+class ArchiveGames(webapp2.RequestHandler):
+    '''Moves finished and canceled Games, with their Boards and Moves, into
+    ArchivedGames, one keys-only page of games per task, so the Game kind
+    and its indexes only hold games in play. A game that can't be archived
+    is logged and skipped, so it doesn't hold up the rest of the chain;
+    the next run tries it again'''
+    def post(self):
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        game_keys, next_cursor, more = Game.query(
+            Game.game_over == True).fetch_page(ARCHIVE_BATCH_SIZE,
+                                               start_cursor=cursor,
+                                               keys_only=True)
+        for game_key in game_keys:
+            try:
+                move_keys = self._archive(game_key)
+            except Exception:
+                logging.exception('Could not archive game %s', game_key)
+                continue
+            # moves are deleted after the transaction so long games don't
+            # overflow it; a Move left behind is unreachable but harmless
+            ndb.delete_multi(move_keys)
+            gamecache.forget(game_key.urlsafe())
+
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/archive_games',
+                          params={'cursor': next_cursor.urlsafe()})
+        self.response.set_status(204)
+
+    @staticmethod
+    @ndb.transactional(xg=True)
+    def _archive(game_key):
+        '''Writes the archive and deletes the Game and its Boards
+        atomically. Returns the keys of the game's Moves'''
+        game = game_key.get()
+        if not game or not game.game_over:
+            return []
+        boards = ndb.get_multi(game.board_keys())
+        ArchivedGame.from_game(game, boards, game.get_moves()).put()
+        ndb.delete_multi([game_key] + game.board_keys())
+        return [Move.key_for(game_key, number)
+                for number in range(len(game.moves) + 1,
+                                    game.last_move() + 1)]
+
+
+class StartStatsReconciliation(webapp2.RequestHandler):
+    def get(self):
+        '''Starts a run of the stats reconciliation'''
+        run = datetime.datetime.utcnow().strftime(ReconcileStats.RUN_FORMAT)
+        taskqueue.add(url='/tasks/reconcile_stats', params={'run': run})
+
+
+class ReconcileStats(webapp2.RequestHandler):
+    '''Recomputes every User's games_played and games_won from the games
+    they finished before the run started, one batch per task:
+    - games, archive: count finished Games and ArchivedGames into a
+      StatsTally per user. Canceled games don't count, as in play
+    - apply: correct each User whose stats differ from its tally, in a
+      transaction that re-reads the User and keeps the leaderboard in
+      step. Users who finished a game since the run started are left to
+      the next run, as their stats include games the tally does not
+    - cleanup: delete the run's tallies
+    The run is the time it started. Each task carries the run, phase,
+    cursor and batch number, so a failed task is retried from where it
+    stopped and the chain can be resumed by re-posting its parameters.
+    Games archived while a run is counting may be miscounted until the
+    next run, so the cron runs it apart from the archive job.'''
+    PHASES = ['games', 'archive', 'apply', 'cleanup']
+    RUN_FORMAT = '%Y%m%d%H%M%S'
+
+    def post(self):
+        run = self.request.get('run')
+        phase = self.request.get('phase') or self.PHASES[0]
+        batch = int(self.request.get('batch') or 0)
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        query = {'games': Game.query(Game.game_over == True),
+                 'archive': ArchivedGame.query(),
+                 'apply': User.query(),
+                 'cleanup': StatsTally.query(StatsTally.run == run)}[phase]
+        entities, next_cursor, more = query.fetch_page(
+            MIGRATION_BATCH_SIZE, start_cursor=cursor,
+            keys_only=phase in ('apply', 'cleanup'))
+
+        getattr(self, '_' + phase)(run, batch, entities)
+
+        params = {'run': run, 'batch': batch + 1}
+        if more and next_cursor:
+            params.update(phase=phase, cursor=next_cursor.urlsafe())
+        elif phase != self.PHASES[-1]:
+            params.update(phase=self.PHASES[self.PHASES.index(phase) + 1])
+        else:
+            params = None
+        if params:
+            taskqueue.add(url='/tasks/reconcile_stats', params=params)
+        self.response.set_status(204)
+
+    @staticmethod
+    def _count(run, batch, results):
+        '''Adds (player_1, player_2, winner) results to the run's tallies'''
+        counts = {}
+        for player_1, player_2, winner in results:
+            if not winner or winner == CANCELED:
+                continue
+            for name in (player_1, player_2):
+                played, won = counts.get(name, (0, 0))
+                counts[name] = (played + 1, won + (name == winner))
+
+        names = list(counts)
+        tallies = ndb.get_multi([StatsTally.key_for(run, name)
+                                 for name in names])
+        changed = []
+        for name, tally in zip(names, tallies):
+            if not tally:
+                tally = StatsTally(key=StatsTally.key_for(run, name), run=run)
+            if batch in tally.batches:
+                continue
+            tally.played += counts[name][0]
+            tally.won += counts[name][1]
+            tally.batches.append(batch)
+            changed.append(tally)
+        ndb.put_multi(changed)
+
+    def _started(self, run):
+        return datetime.datetime.strptime(run, self.RUN_FORMAT)
+
+    def _games(self, run, batch, games):
+        started = self._started(run)
+        # games finished before their finish time was recorded count too
+        games = [game for game in games
+                 if not game.finished or game.finished < started]
+        names = Game.user_names([key for game in games
+                                 for key in game.player_keys()])
+        self._count(run, batch, [(names[game.player_1],
+                                  names[game.player_2],
+                                  game.winner) for game in games])
+
+    def _archive(self, run, batch, archives):
+        started = self._started(run)
+        results = []
+        for archive in archives:
+            finished = archive.data.get('finished')
+            if finished and datetime.datetime.strptime(
+                    finished[:19], '%Y-%m-%dT%H:%M:%S') >= started:
+                continue
+            results.append((archive.data['player_1'],
+                            archive.data['player_2'],
+                            archive.data['winner']))
+        self._count(run, batch, results)
+
+    @staticmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _correct_async(user_key, tally, started):
+        '''Sets a User's stats to its tally, unless they already match or
+        the user has finished a game since the run started. Returns
+        whether the User was changed'''
+        user = yield user_key.get_async()
+        if not user or (user.last_finished and
+                        user.last_finished >= started):
+            raise ndb.Return(False)
+        played, won = (tally.played, tally.won) if tally else (0, 0)
+        if (user.games_played, user.games_won) == (played, won):
+            raise ndb.Return(False)
+        old_pctg = user.win_pctg
+        user.games_played = played
+        user.games_won = won
+        yield (user.put_async(),
+               leaderboard.record_changes_async([(old_pctg,
+                                                  user.win_pctg)]))
+        raise ndb.Return(True)
+
+    def _apply(self, run, batch, user_keys):
+        started = self._started(run)
+        tallies = ndb.get_multi([StatsTally.key_for(run, key.id())
+                                 for key in user_keys])
+        futures = [self._correct_async(key, tally, started)
+                   for key, tally in zip(user_keys, tallies)]
+        changed = [key.id() for key, future in zip(user_keys, futures)
+                   if future.get_result()]
+        if changed:
+            logging.info('Corrected stats of %d users: %s', len(changed),
+                         ', '.join(changed))
+
+    def _cleanup(self, run, batch, tally_keys):
+        ndb.delete_multi(tally_keys)
+
+
+class WarmUp(webapp2.RequestHandler):
+    '''Prepares a new instance before it is sent traffic: loads the API
+    and primes the leaderboard and active game caches'''
+    def get(self):
+        for module in WARMUP_MODULES:
+            importlib.import_module(module)
+        leaderboard.get_histogram()
+        leaderboard.get_top()
+        counter.cache_active_games()
+        metrics.get_slow_ms()
+        self.response.set_status(204)
+
+
+class StatsPage(webapp2.RequestHandler):
+    '''Shows per-endpoint RPC counts and wall time as JSON. POST slow_ms to
+    set the slow-request log threshold (0 turns it off), or reset=1 to
+    clear the counters'''
+    @staticmethod
+    def _endpoint_names():
+        # the API is only imported here, so task and cron requests don't
+        # have to load it
+        from api import BattleshipApi
+        names = set(metrics.endpoints())
+        names.update(BattleshipApi.all_remote_methods())
+        return names
+
+    def get(self):
+        stats = metrics.get_stats(self._endpoint_names())
+        for totals in stats.values():
+            requests = totals['requests'] or 1
+            totals['per_request'] = dict(
+                (field, round(float(totals[field]) / requests, 2))
+                for field in metrics.FIELDS if field != 'requests')
+        self.response.headers['Content-Type'] = 'application/json'
+        self.response.write(json.dumps({'slow_ms': metrics.get_slow_ms(),
+                                        'endpoints': stats},
+                                       indent=2, sort_keys=True))
+
+    def post(self):
+        if self.request.get('slow_ms'):
+            metrics.set_slow_ms(int(self.request.get('slow_ms')))
+        if self.request.get('reset'):
+            metrics.reset_stats(self._endpoint_names())
+        self.redirect('/admin/stats')
+
+
+ROUTES = [
     ('/crons/send_reminder', SendReminderEmail),
-    ('tasks/updateactivegames', UpdateActiveGames),
-], debug=True)
+    ('/crons/reconcile_active_games', ReconcileActiveGames),
+    ('/crons/archive_games', ArchiveFinishedGames),
+    ('/crons/reconcile_stats', StartStatsReconciliation),
+    ('/tasks/updateactivegames', UpdateActiveGames),
+    ('/tasks/send_reminders', SendReminderBatch),
+    ('/tasks/rebuild_leaderboard', RebuildLeaderboard),
+    ('/tasks/backfill_pairings', BackfillPairings),
+    ('/tasks/migrate_boards', MigrateBoards),
+    ('/tasks/migrate_keys', MigrateKeys),
+    ('/tasks/archive_games', ArchiveGames),
+    ('/tasks/reconcile_stats', ReconcileStats),
+    ('/admin/stats', StatsPage),
+    ('/_ah/warmup', WarmUp),
+]
+
+app = metrics.instrument(webapp2.WSGIApplication(ROUTES, debug=True),
+                         [path for path, _ in ROUTES])
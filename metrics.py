@@ -0,0 +1,185 @@
+"""metrics.py - Per-endpoint RPC and latency instrumentation.
+
+instrument() wraps a WSGI application so that every request is timed and
+its RPCs are counted by apiproxy hooks: datastore entities read by get,
+queries run and entities returned by them, entities put and deleted, and
+memcache hits and misses. The endpoint is the method name for API calls
+and the path for everything else. At the end of a request its counts are
+added to per-endpoint memcache counters with a single offset_multi, so the
+numbers are approximate: they restart when memcache evicts them.
+
+Requests slower than the slow-request threshold are logged along with
+their RPC trace. The threshold lives in memcache so it can be changed for
+all instances from the admin stats page; 0 turns the log off."""
+
+import logging
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+FIELDS = ('requests', 'wall_ms', 'ds_gets', 'ds_queries', 'ds_results',
+          'ds_puts', 'ds_deletes', 'mc_hits', 'mc_misses')
+SLOW_MS_KEY = 'metrics:slow_ms'
+SLOW_MS_CACHE_SECONDS = 60
+API_PATH = '/_ah/spi/'
+
+_ENDPOINTS = set()
+_local = threading.local()
+_slow_ms = {'value': 0, 'expires': 0}
+_hooks_installed = []
+
+
+def _key_prefix(endpoint):
+    return 'metrics:{}:'.format(endpoint)
+
+
+class _Request(object):
+    '''Counts and RPC trace for the request running on this thread'''
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.start = time.time()
+        self.counts = dict.fromkeys(FIELDS, 0)
+        self.counts['requests'] = 1
+        self.trace = []
+        self._pending = {}
+
+    def begin_rpc(self, rpc_id):
+        self._pending[rpc_id] = time.time()
+
+    def end_rpc(self, rpc_id, service, call, detail):
+        started = self._pending.pop(rpc_id, None)
+        elapsed = (time.time() - started) * 1000 if started else 0
+        self.trace.append((time.time() - self.start, service, call,
+                           elapsed, detail))
+
+
+def _pre_call(service, call, request, response):
+    record = getattr(_local, 'request', None)
+    if record is not None:
+        record.begin_rpc(id(response))
+
+
+def _post_call(service, call, request, response):
+    record = getattr(_local, 'request', None)
+    if record is None:
+        return
+    counts = record.counts
+    detail = ''
+    if service == 'datastore_v3':
+        if call == 'Get':
+            counts['ds_gets'] += len(request.key_list())
+            detail = '{} keys'.format(len(request.key_list()))
+        elif call == 'RunQuery':
+            counts['ds_queries'] += 1
+            counts['ds_results'] += len(response.result_list())
+            detail = '{} results'.format(len(response.result_list()))
+        elif call == 'Next':
+            counts['ds_results'] += len(response.result_list())
+            detail = '{} results'.format(len(response.result_list()))
+        elif call == 'Put':
+            counts['ds_puts'] += len(request.entity_list())
+            detail = '{} entities'.format(len(request.entity_list()))
+        elif call == 'Delete':
+            counts['ds_deletes'] += len(request.key_list())
+            detail = '{} keys'.format(len(request.key_list()))
+    elif service == 'memcache' and call == 'Get':
+        hits = len(response.item_list())
+        counts['mc_hits'] += hits
+        counts['mc_misses'] += len(request.key_list()) - hits
+        detail = '{} hits of {}'.format(hits, len(request.key_list()))
+    record.end_rpc(id(response), service, call, detail)
+
+
+def _install_hooks():
+    if _hooks_installed:
+        return
+    apiproxy = apiproxy_stub_map.apiproxy
+    apiproxy.GetPreCallHooks().Append('metrics', _pre_call)
+    apiproxy.GetPostCallHooks().Append('metrics', _post_call)
+    _hooks_installed.append(True)
+
+
+def endpoint_name(environ):
+    '''The method name for API calls, the path for other requests'''
+    path = environ.get('PATH_INFO', '')
+    if path.startswith(API_PATH):
+        return path[len(API_PATH):].rsplit('.', 1)[-1]
+    return path
+
+
+def endpoints():
+    '''Names of every endpoint of the instrumented applications'''
+    return sorted(_ENDPOINTS)
+
+
+def get_slow_ms():
+    '''The slow-request threshold, cached per instance for
+    SLOW_MS_CACHE_SECONDS'''
+    now = time.time()
+    if now >= _slow_ms['expires']:
+        _slow_ms['value'] = memcache.get(SLOW_MS_KEY) or 0
+        _slow_ms['expires'] = now + SLOW_MS_CACHE_SECONDS
+    return _slow_ms['value']
+
+
+def set_slow_ms(value):
+    '''Sets the slow-request threshold for all instances; 0 disables the
+    log'''
+    memcache.set(SLOW_MS_KEY, value)
+    _slow_ms['value'] = value
+    _slow_ms['expires'] = time.time() + SLOW_MS_CACHE_SECONDS
+
+
+def get_stats(names=None):
+    '''Returns {endpoint: {field: total}} for endpoints that have been
+    called since their counters were last reset'''
+    stats = {}
+    for name in names or endpoints():
+        values = memcache.get_multi(FIELDS, key_prefix=_key_prefix(name))
+        if values:
+            stats[name] = dict((field, values.get(field, 0))
+                               for field in FIELDS)
+    return stats
+
+
+def reset_stats(names=None):
+    for name in names or endpoints():
+        memcache.delete_multi(FIELDS, key_prefix=_key_prefix(name))
+
+
+def _finish(record):
+    wall_ms = (time.time() - record.start) * 1000
+    record.counts['wall_ms'] = int(wall_ms)
+    memcache.offset_multi(record.counts,
+                          key_prefix=_key_prefix(record.endpoint),
+                          initial_value=0)
+    slow_ms = get_slow_ms()
+    if slow_ms and wall_ms >= slow_ms:
+        trace = '\n'.join('  +{:.0f}ms {}.{} {:.1f}ms {}'.format(
+            offset * 1000, service, call, elapsed, detail)
+            for offset, service, call, elapsed, detail in record.trace)
+        logging.warning('Slow request %s: %.0fms, %d RPCs\n%s',
+                        record.endpoint, wall_ms, len(record.trace), trace)
+
+
+def instrument(app, names=()):
+    '''Wraps a WSGI application so its requests are measured. names lists
+    the application's endpoints for the stats page'''
+    _install_hooks()
+    _ENDPOINTS.update(names)
+
+    def measured_app(environ, start_response):
+        record = _Request(endpoint_name(environ))
+        _local.request = record
+        try:
+            return app(environ, start_response)
+        finally:
+            # the stats RPCs below are not part of the request
+            _local.request = None
+            try:
+                _finish(record)
+            except Exception:
+                logging.exception('Could not record request metrics')
+    return measured_app
@@ -1,23 +1,39 @@
 from protorpc import messages
 from google.appengine.ext import ndb
 
+from grid import (
+    DEFAULT_GRID_SIZE,
+    coords_to_layer,
+    layer_coords,
+    pack_layers,
+    unpack_bitboards,
+    unpack_layers)
+
 
 class User(ndb.Model):
-    '''User profile'''
+    '''User profile, keyed by user_name'''
     user_name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
     games_played = ndb.IntegerProperty(required=True, default=0)
     games_won = ndb.IntegerProperty(required=True, default=0)
     win_pctg = ndb.ComputedProperty(lambda self: 0 if self.games_played == 0
                                     else
-                                    int(100*(self.games_won/self.games_played)))
+                                    100 * self.games_won // self.games_played)
+    # when a game that counted towards the stats above last finished
+    last_finished = ndb.DateTimeProperty(indexed=False)
 
-    def to_form(self):
+    @classmethod
+    def key_for(cls, user_name):
+        '''Returns the key of the User with user_name'''
+        return ndb.Key(cls, user_name)
+
+    def to_form(self, rank=None):
         form = PlayerStatsForm()
         form.user_name = self.user_name
         form.games_played = self.games_played
         form.games_won = self.games_won
         form.win_pctg = self.win_pctg
+        form.rank = rank
 
         return form
 
@@ -29,37 +45,96 @@ class Game(ndb.Model):
     game_over = ndb.BooleanProperty(required=True, default=False)
     next_player = ndb.KeyProperty(kind='User')
     winner = ndb.StringProperty(default=None)
+    grid_size = ndb.IntegerProperty(default=DEFAULT_GRID_SIZE, indexed=False)
+    move_count = ndb.IntegerProperty(default=0, indexed=False)
+    # goes up with every change to the game or its boards
+    version = ndb.IntegerProperty(default=0, indexed=False)
+    # legacy in-entity move log; new moves are Move children of the game
     moves = ndb.StringProperty(repeated=True)
+    finished = ndb.DateTimeProperty(indexed=False)
 
     @classmethod
-    def new_game(cls, p1, p2):
-        '''Initiates new game'''
-        game = Game(player_1=p1,
+    def new_game(cls, p1, p2, key=None, grid_size=DEFAULT_GRID_SIZE):
+        '''Initiates new game; the caller puts it'''
+        return Game(key=key,
+                    player_1=p1,
                     player_2=p2,
                     next_player=p1,
-                    moves=[])
-        game.put()
-        return game
+                    grid_size=grid_size)
+
+    def slot_of(self, user_key):
+        '''Returns 1 or 2 for the player's seat in this game, or None'''
+        if user_key == self.player_1:
+            return 1
+        if user_key == self.player_2:
+            return 2
+        return None
+
+    def board_keys(self):
+        '''Returns the keys of the player 1 and player 2 boards'''
+        return [Board.key_for(self.key, 1), Board.key_for(self.key, 2)]
 
     def end_game(self, winner):
         self.game_over = True
         self.winner = winner
         self.put()
 
-    def insert_move(self, player_name, guess_coord, result):
-        guess = '{}_{}'.format(*guess_coord)
-        self.moves.append('name-{}.coord-{}.result-{}'.format(player_name,
-                                                              guess,
-                                                              result))
-        self.put()
+    def last_move(self):
+        '''Number of the most recent move, counting legacy moves'''
+        return len(self.moves) + self.move_count
+
+    def get_moves(self, since_move=0, limit=None):
+        '''Returns move strings after move number since_move, oldest first.
+        Legacy moves come from the moves list, the rest by key'''
+        last = self.last_move()
+        if limit is not None:
+            last = min(last, since_move + limit)
+        legacy = self.moves[since_move:last]
+        first = max(since_move, len(self.moves)) + 1
+        keys = [Move.key_for(self.key, number)
+                for number in range(first, last + 1)]
+        return legacy + [move.to_string()
+                         for move in ndb.get_multi(keys) if move]
+
+    def player_keys(self):
+        return [key for key in (self.player_1, self.player_2,
+                                self.next_player) if key]
+
+    @staticmethod
+    def user_names(user_keys):
+        '''Maps User keys to user names. Users are keyed by user_name, so
+        only keys left over from before the key migration need a lookup,
+        and those are resolved with a single get_multi'''
+        names = {}
+        legacy = []
+        for key in set(user_keys):
+            if isinstance(key.id(), basestring):
+                names[key] = key.id()
+            else:
+                legacy.append(key)
+        for key, user in zip(legacy, ndb.get_multi(legacy)):
+            names[key] = user.user_name if user else None
+        return names
 
-    def to_form(self, message=''):
+    @classmethod
+    def to_forms(cls, games, message=''):
+        '''Renders GameForms for many games with at most one datastore RPC'''
+        names = cls.user_names([key for game in games
+                                for key in game.player_keys()])
+        return [game.to_form(message, names) for game in games]
+
+    def to_form(self, message='', names=None):
+        if names is None:
+            names = self.user_names(self.player_keys())
         form = GameForm()
         form.urlsafe_key = self.key.urlsafe()
-        form.p1_name = self.player_1.get().user_name
-        form.p2_name = self.player_2.get().user_name
-        form.next_player = self.next_player.get().user_name
+        form.p1_name = names[self.player_1]
+        form.p2_name = names[self.player_2]
+        if self.next_player:
+            form.next_player = names[self.next_player]
         form.game_over = self.game_over
+        form.grid_size = self.grid_size
+        form.version = self.version
         if self.winner:
             form.winner = self.winner
         else:
@@ -69,62 +144,217 @@ class Game(ndb.Model):
 
 
 class Board(ndb.Model):
-    '''Tracks each player's board, keeps a list of ship coordinates'''
+    '''Tracks each player's board. Ship, hit and miss cells are kept as
+    sparse cell index sets packed into the single cells property. Boards
+    are children of their Game, with ids player-1 and player-2'''
     urlsafe_game_key = ndb.StringProperty(required=True)
     player = ndb.KeyProperty(required=True, kind='User')
     opponent = ndb.KeyProperty(required=True, kind='User')
+    grid_size = ndb.IntegerProperty(default=DEFAULT_GRID_SIZE, indexed=False)
+    cells = ndb.BlobProperty()
+    # legacy 10x10 bitboards and "x_y" string lists, read only until the
+    # board is migrated
+    layers = ndb.BlobProperty()
     ship_coord = ndb.StringProperty(repeated=True)
     hit_coord = ndb.StringProperty(repeated=True)
     miss_coord = ndb.StringProperty(repeated=True)
 
-    def to_form(self, message=''):
-        '''Returns board data in BoardForm'''
-        form = BoardForm()
-        form.urlsafe_key = self.urlsafe_game_key
-        form.hits = len(self.hit_coord)
-        form.misses = len(self.miss_coord)
-
-        ship_cells = len(self.ship_coord)
-        remaining = ship_cells - form.hits
-        form.remaining = remaining
-        form.message = message
-
-        return form
+    @classmethod
+    def key_for(cls, game_key, slot):
+        '''Returns the key of the board for seat slot (1 or 2) in a game'''
+        return ndb.Key(cls, 'player-{}'.format(slot), parent=game_key)
+
+    def get_layers(self):
+        '''Returns (ships, hits, misses) sets of cell indices'''
+        if self.cells is not None:
+            return unpack_layers(self.cells)
+        if self.layers is not None:
+            return unpack_bitboards(self.layers)
+        return (coords_to_layer(self.ship_coord),
+                coords_to_layer(self.hit_coord),
+                coords_to_layer(self.miss_coord))
+
+    def set_layers(self, ships, hits, misses):
+        '''Stores cell sets, dropping any legacy representation'''
+        self.cells = pack_layers(ships, hits, misses)
+        self.layers = None
+        self.ship_coord = []
+        self.hit_coord = []
+        self.miss_coord = []
+
+    def needs_migration(self):
+        return self.cells is None
 
     def giveCoords(self, nature):
+        ships, hits, misses = self.get_layers()
         if nature == 'ship':
-            q = self.ship_coord
+            layer = ships
         elif nature == 'hit':
-            q = self.hit_coord
+            layer = hits
         elif nature == 'miss':
-            q = self.miss_coord
-        coords = []
-        for item in q:
-            x = int(item.split('_')[0])
-            y = int(item.split('_')[1])
-            coord = [x, y]
-            coords.append(coord)
-
-        return coords
+            layer = misses
+        return layer_coords(layer, self.grid_size)
 
     def coordsToForm(self, nature):
         coords = self.giveCoords(nature)
-        return CoordsForm(coord=[coord for coord in coords])
+        return CoordsForm(coord=['{}_{}'.format(*coord) for coord in coords])
+
+
+class ActivePairing(ndb.Model):
+    '''Marks that two users have an active game together. Keyed by the
+    sorted pair of user names so a pair has exactly one possible key'''
+    game = ndb.KeyProperty(required=True, kind='Game', indexed=False)
+
+    @classmethod
+    def key_for(cls, p1_key, p2_key):
+        first, second = sorted([p1_key.id(), p2_key.id()])
+        return ndb.Key(cls, first, cls, second)
+
+    @classmethod
+    def key_for_game(cls, game):
+        return cls.key_for(game.player_1, game.player_2)
+
+
+class Move(ndb.Model):
+    '''A single guess, stored as a child of its Game with the move number
+    as its id'''
+    player_name = ndb.StringProperty(required=True, indexed=False)
+    x = ndb.IntegerProperty(required=True, indexed=False)
+    y = ndb.IntegerProperty(required=True, indexed=False)
+    result = ndb.StringProperty(required=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, game_key, number):
+        return ndb.Key(cls, number, parent=game_key)
+
+    def to_string(self):
+        return 'name-{}.coord-{}_{}.result-{}'.format(self.player_name,
+                                                     self.x,
+                                                     self.y,
+                                                     self.result)
+
+
+class ArchivedGame(ndb.Model):
+    '''A finished or canceled Game, its Boards and its move log, moved out
+    of the Game kind by the archive task. Keyed by the id of the Game it
+    replaces, and has no indexed properties'''
+    archived = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    data = ndb.JsonProperty(compressed=True)
+
+    @classmethod
+    def key_for(cls, game_key):
+        return ndb.Key(cls, game_key.id())
+
+    @classmethod
+    def from_game(cls, game, boards, moves):
+        '''Builds the archive of a game from the game, its boards and its
+        move strings'''
+        names = Game.user_names(game.player_keys() +
+                                [board.player for board in boards if board])
+        archived_boards = []
+        for board in boards:
+            if not board:
+                continue
+            ships, hits, misses = board.get_layers()
+            archived_boards.append({'player': names[board.player],
+                                    'ships': sorted(ships),
+                                    'hits': sorted(hits),
+                                    'misses': sorted(misses)})
+        return cls(key=cls.key_for(game.key),
+                   data={'urlsafe_key': game.key.urlsafe(),
+                         'player_1': names[game.player_1],
+                         'player_2': names[game.player_2],
+                         'winner': game.winner,
+                         'grid_size': game.grid_size,
+                         'version': game.version,
+                         'finished': (game.finished.isoformat()
+                                      if game.finished else None),
+                         'boards': archived_boards,
+                         'moves': moves})
+
+    def to_form(self):
+        data = self.data
+        return ArchivedGameForm(urlsafe_key=data['urlsafe_key'],
+                                p1_name=data['player_1'],
+                                p2_name=data['player_2'],
+                                winner=data['winner'],
+                                grid_size=data['grid_size'],
+                                items=data['moves'],
+                                last_move=len(data['moves']))
+
+
+class Tournament(ndb.Model):
+    '''A round robin, with every game created up front, or a single
+    elimination bracket, created one round at a time. games holds the
+    current round's games'''
+    format = ndb.StringProperty(required=True, indexed=False)
+    players = ndb.StringProperty(repeated=True, indexed=False)
+    grid_size = ndb.IntegerProperty(default=DEFAULT_GRID_SIZE, indexed=False)
+    round = ndb.IntegerProperty(default=1, indexed=False)
+    games = ndb.KeyProperty(kind='Game', repeated=True, indexed=False)
+    byes = ndb.StringProperty(repeated=True, indexed=False)
+    winner = ndb.StringProperty(indexed=False)
+
+
+class MatchQueue(ndb.Model):
+    '''Players waiting for an opponent on one grid size, longest waiting
+    first. Keyed by the grid size'''
+    waiting = ndb.StringProperty(repeated=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, grid_size):
+        return ndb.Key(cls, str(grid_size))
+
+
+class StatsTally(ndb.Model):
+    '''A user's games played and won as counted by one run of the stats
+    reconciliation task. batches lists the batches of games already
+    counted, so a retried batch is not counted twice'''
+    run = ndb.StringProperty(required=True)
+    played = ndb.IntegerProperty(default=0, indexed=False)
+    won = ndb.IntegerProperty(default=0, indexed=False)
+    batches = ndb.IntegerProperty(repeated=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, run, user_name):
+        return ndb.Key(cls, '{}:{}'.format(run, user_name))
+
+
+class ReminderSent(ndb.Model):
+    '''Marks that a user was sent their turn reminder on a given date'''
+    sent = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+    @classmethod
+    def key_for(cls, date, user_key):
+        return ndb.Key(cls, '{}:{}'.format(date, user_key.id()))
+
+    @classmethod
+    def mark_multi(cls, date, user_keys):
+        '''Records the reminders with one get_multi and one put_multi,
+        returning the keys of the users who had not been sent one yet'''
+        keys = [cls.key_for(date, user_key) for user_key in user_keys]
+        unsent = [(user_key, key) for user_key, key, sent
+                  in zip(user_keys, keys, ndb.get_multi(keys)) if not sent]
+        ndb.put_multi([cls(key=key) for _, key in unsent])
+        return [user_key for user_key, _ in unsent]
 
 
 class BoardForm(messages.Message):
     '''Board information for outbound board status'''
     urlsafe_key = messages.StringField(1, required=True)
-    hits = messages.IntegerField(2, required=True)
-    misses = messages.IntegerField(3, required=True)
-    remaining = messages.IntegerField(4, required=True)
+    hits = messages.IntegerField(2)
+    misses = messages.IntegerField(3)
+    remaining = messages.IntegerField(4)
     message = messages.StringField(5)
+    version = messages.IntegerField(6)
+    not_modified = messages.BooleanField(7)
 
 
 class NewGameForm(messages.Message):
     '''Used to start a new game'''
     p1_username = messages.StringField(1, required=True)
     p2_username = messages.StringField(2, required=True)
+    grid_size = messages.IntegerField(3)
 
 
 class GameForm(messages.Message):
@@ -136,14 +366,63 @@ class GameForm(messages.Message):
     game_over = messages.BooleanField(5, required=True)
     winner = messages.StringField(6)
     message = messages.StringField(7)
+    grid_size = messages.IntegerField(8)
+    version = messages.IntegerField(9)
 
 
 class GameHistoryForm(messages.Message):
     items = messages.StringField(1, repeated=True)
+    last_move = messages.IntegerField(2)
+    version = messages.IntegerField(3)
+    not_modified = messages.BooleanField(4)
+
+
+class ArchivedGameForm(messages.Message):
+    '''A finished game's players, result and full move log'''
+    urlsafe_key = messages.StringField(1, required=True)
+    p1_name = messages.StringField(2, required=True)
+    p2_name = messages.StringField(3, required=True)
+    winner = messages.StringField(4)
+    grid_size = messages.IntegerField(5)
+    items = messages.StringField(6, repeated=True)
+    last_move = messages.IntegerField(7)
+
+
+class NewTournamentForm(messages.Message):
+    '''Used to start a tournament. format is round_robin or bracket'''
+    player_names = messages.StringField(1, repeated=True)
+    format = messages.StringField(2, required=True)
+    grid_size = messages.IntegerField(3)
+
+
+class TournamentForm(messages.Message):
+    '''A tournament and the games of its current round'''
+    urlsafe_key = messages.StringField(1, required=True)
+    format = messages.StringField(2, required=True)
+    round = messages.IntegerField(3)
+    games = messages.MessageField(GameForm, 4, repeated=True)
+    byes = messages.StringField(5, repeated=True)
+    winner = messages.StringField(6)
+    message = messages.StringField(7)
+
+
+class MatchmakingForm(messages.Message):
+    '''Used to join the matchmaking queue'''
+    user_name = messages.StringField(1, required=True)
+    grid_size = messages.IntegerField(2)
+
+
+class MatchForm(messages.Message):
+    '''The game matchmaking started, if an opponent was waiting'''
+    message = messages.StringField(1, required=True)
+    game = messages.MessageField(GameForm, 2)
 
 
 class ActiveGamesForm(messages.Message):
     items = messages.MessageField(GameForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
+    version = messages.IntegerField(3)
+    not_modified = messages.BooleanField(4)
 
 
 class InsertShipForm(messages.Message):
@@ -156,6 +435,22 @@ class InsertShipForm(messages.Message):
     horizontal = messages.BooleanField(6, required=True)
 
 
+class ShipForm(messages.Message):
+    '''A single ship placement'''
+    start_x = messages.IntegerField(1, required=True)
+    start_y = messages.IntegerField(2, required=True)
+    length = messages.IntegerField(3, required=True)
+    horizontal = messages.BooleanField(4, required=True)
+
+
+class InsertFleetForm(messages.Message):
+    '''Used to place a player's whole fleet at once. Leave ships empty to
+    have the server place the standard fleet at random'''
+    player_name = messages.StringField(1, required=True)
+    urlsafe_game_key = messages.StringField(2, required=True)
+    ships = messages.MessageField(ShipForm, 3, repeated=True)
+
+
 class MakeGuessForm(messages.Message):
     '''Inputs a player guess'''
     guess_x = messages.IntegerField(1, required=True)
@@ -180,11 +475,13 @@ class PlayerStatsForm(messages.Message):
     games_played = messages.IntegerField(2, required=True)
     games_won = messages.IntegerField(3, required=True)
     win_pctg = messages.IntegerField(4, required=True)
+    rank = messages.IntegerField(5)
 
 
 class PlayersStatsForm(messages.Message):
     '''return multiple outbound player stats'''
     players = messages.MessageField(PlayerStatsForm, 1, repeated=True)
+    next_cursor = messages.StringField(2)
 
 
 class StringMessage(messages.Message):
@@ -0,0 +1,368 @@
+"""storage.py - The ndb storage backend for engine.GameEngine.
+
+Games are keyed by their urlsafe Game key. Updates are played against the
+live game snapshot in memcache when there is one and written to the
+datastore in a transaction that checks the game is still at the
+snapshot's version, after which the new snapshot is published with a
+compare-and-set. Otherwise they are played in a datastore transaction
+after which the snapshot is cached (see gamecache.py). Ending a game
+also updates the players' stats, the active game counter, the pairing
+index and the leaderboard in the transaction that writes it."""
+
+import datetime
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import counter
+import gamecache
+import leaderboard
+from engine import (
+    CANCELED,
+    COMPUTER_NAME,
+    BoardState,
+    GameState,
+    InvalidRequest,
+    NotFound,
+    Storage)
+from models import ActivePairing, Board, Game, Move, User
+
+CAS_ATTEMPTS = 3
+
+COMPUTER_KEY = User.key_for(COMPUTER_NAME)
+
+
+class _StaleSnapshot(Exception):
+    '''The game was changed in the datastore after the snapshot an update
+    was played against was cached'''
+
+
+def _game_key(urlsafe_game_key):
+    '''Decodes a urlsafe Game key. Raises InvalidRequest if it is malformed
+    or not a Game key'''
+    try:
+        key = ndb.Key(urlsafe=urlsafe_game_key)
+    except TypeError:
+        raise InvalidRequest('Invalid Key')
+    except Exception as e:
+        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
+            raise InvalidRequest('Invalid Key')
+        raise
+    if key.kind() != Game._get_kind():
+        raise InvalidRequest('Incorrect Kind')
+    return key
+
+
+def _game_and_boards_async(urlsafe_game_key):
+    '''Gets a Game and both of its Boards with one get_multi. Returns a
+    Future for (game, board_1, board_2), game being None if there is no
+    such game'''
+    key = _game_key(urlsafe_game_key)
+    return ndb.get_multi_async([key, Board.key_for(key, 1),
+                                Board.key_for(key, 2)])
+
+
+def _game_state(game):
+    '''Reads a Game entity into a GameState'''
+    names = Game.user_names(game.player_keys())
+    return GameState(names[game.player_1], names[game.player_2],
+                     grid_size=game.grid_size,
+                     key=game.key.urlsafe(),
+                     next_player=names.get(game.next_player),
+                     game_over=game.game_over,
+                     winner=game.winner,
+                     last_move=game.last_move(),
+                     version=game.version)
+
+
+def _board_state(board, player_name):
+    ships, hits, misses = board.get_layers()
+    return BoardState(player_name, board.grid_size, ships, hits, misses)
+
+
+class NdbStorage(Storage):
+    '''Stores games as Game, Board and Move entities'''
+
+    def create_game(self, game, boards):
+        if game.player_2 == COMPUTER_NAME:
+            self._ensure_computer_user()
+        return self._new_game_async(game, boards).get_result()
+
+    def create_games(self, games, boards):
+        if any(game.player_2 == COMPUTER_NAME for game in games):
+            self._ensure_computer_user()
+        return self._new_games_async(games, boards).get_result()
+
+    def update_game(self, game_key, apply):
+        return self._update_game_async(game_key, apply).get_result()
+
+    def get_version(self, game_key):
+        '''Served from memcache, falling back to a get of the Game'''
+        cached = gamecache.get_version(game_key)
+        if cached is not None:
+            return cached
+        game = _game_key(game_key).get()
+        if not game:
+            return None
+        names = Game.user_names(game.player_keys())
+        next_player = names.get(game.next_player)
+        gamecache.set_version(game_key, game.version, next_player)
+        return game.version, next_player
+
+    @staticmethod
+    def _cache_version(state):
+        '''Publishes a game's new version once it has been written'''
+        gamecache.set_version(state.key, state.version, state.next_player)
+        gamecache.bump_list_version()
+
+    @staticmethod
+    @ndb.transactional_tasklet(xg=True)
+    def create_user_async(user_name, email):
+        '''Creates a User and counts it on the leaderboard, atomically.
+        Raises InvalidRequest if the name is taken'''
+        if (yield User.key_for(user_name).get_async()):
+            raise InvalidRequest('A user with that name already exists!')
+        user = User(id=user_name,
+                    user_name=user_name,
+                    email=email)
+        yield (user.put_async(),
+               leaderboard.record_changes_async([(None, user.win_pctg)]))
+
+    @classmethod
+    def _ensure_computer_user(cls):
+        '''Creates the computer's User the first time someone plays it'''
+        if not COMPUTER_KEY.get():
+            try:
+                cls.create_user_async(COMPUTER_NAME, None).get_result()
+            except InvalidRequest:
+                pass
+
+    @classmethod
+    @ndb.tasklet
+    def _new_game_async(cls, state, boards):
+        p1_key = User.key_for(state.player_1)
+        p2_key = User.key_for(state.player_2)
+
+        # the user lookups and game id allocation are independent, so they
+        # run concurrently
+        p1, p2, (game_id, _) = yield [p1_key.get_async(),
+                                      p2_key.get_async(),
+                                      Game.allocate_ids_async(1)]
+        if not p1 or not p2:
+            raise InvalidRequest('Both players must be valid users!')
+
+        game_key = ndb.Key(Game, game_id)
+        yield cls._create_game_async(game_key, p1_key, p2_key, state, boards)
+        yield taskqueue.Queue().add_async(
+            taskqueue.Task(url='/tasks/updateactivegames'))
+        state.key = game_key.urlsafe()
+        cls._cache_version(state)
+        raise ndb.Return(state)
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _create_game_async(cls, game_key, p1_key, p2_key, state, boards):
+        '''Creates a game, both boards and the players' pairing and counts
+        the game as active, atomically'''
+        # check to verify players aren't already in ongoing game
+        pairing_key = ActivePairing.key_for(p1_key, p2_key)
+        if (yield pairing_key.get_async()):
+            raise InvalidRequest('These players already have an active game!')
+
+        entities = cls._game_entities(game_key, p1_key, p2_key, state,
+                                      boards)
+        yield (ndb.put_multi_async(entities) +
+               [counter.increment_async(counter.ACTIVE_GAMES)])
+
+    @classmethod
+    @ndb.tasklet
+    def _new_games_async(cls, states, boards):
+        '''Creates many games with one get_multi for the players and their
+        pairings, one put_multi and one counter update. Unlike a single
+        game this is not one transaction, as a tournament spans more
+        entity groups than a transaction can; a new_game racing it for
+        the same pair can leave that pair with two games'''
+        seats = [(User.key_for(state.player_1), User.key_for(state.player_2))
+                 for state in states]
+        user_keys = list(set(key for seat in seats for key in seat))
+        pairing_keys = [ActivePairing.key_for(*seat) for seat in seats]
+        results = yield (ndb.get_multi_async(user_keys + pairing_keys) +
+                         [Game.allocate_ids_async(len(states))])
+        users = results[:len(user_keys)]
+        pairings = results[len(user_keys):-1]
+        first_id, _ = results[-1]
+        if not all(users):
+            raise InvalidRequest('All players must be valid users!')
+        if any(pairings):
+            raise InvalidRequest('These players already have an active game!')
+
+        entities = []
+        for number, (state, seat) in enumerate(zip(states, seats)):
+            game_key = ndb.Key(Game, first_id + number)
+            entities.extend(cls._game_entities(game_key, seat[0], seat[1],
+                                               state, boards[number]))
+            state.key = game_key.urlsafe()
+        # ndb can only wait on a list of Futures, so the task RPC is
+        # started alongside the writes and waited on by itself
+        task = taskqueue.Queue().add_async(
+            taskqueue.Task(url='/tasks/updateactivegames'))
+        yield (ndb.put_multi_async(entities) +
+               [counter.increment_async(counter.ACTIVE_GAMES, len(states))])
+        yield task
+        gamecache.add_versions(dict((state.key, (state.version,
+                                                 state.next_player))
+                                    for state in states))
+        gamecache.bump_list_version()
+        raise ndb.Return(states)
+
+    @staticmethod
+    def _game_entities(game_key, p1_key, p2_key, state, boards):
+        '''Builds a new Game, its pairing and both Boards'''
+        game = Game.new_game(p1_key, p2_key, key=game_key,
+                             grid_size=state.grid_size)
+        entities = [game, ActivePairing(key=ActivePairing.key_for(p1_key,
+                                                                  p2_key),
+                                        game=game_key)]
+        urlsafe_game_key = game_key.urlsafe()
+        for slot, (player_key, opponent_key) in enumerate(
+                [(p1_key, p2_key), (p2_key, p1_key)], 1):
+            board = Board(key=Board.key_for(game_key, slot),
+                          player=player_key,
+                          opponent=opponent_key,
+                          urlsafe_game_key=urlsafe_game_key,
+                          grid_size=state.grid_size)
+            board_state = boards[slot - 1]
+            board.set_layers(board_state.ships, board_state.hits,
+                             board_state.misses)
+            entities.append(board)
+        return entities
+
+    @classmethod
+    @ndb.tasklet
+    def _update_game_async(cls, urlsafe_game_key, apply):
+        '''Applies an update to the live game snapshot when there is one,
+        falling back to a transaction otherwise. The snapshot is only
+        replaced once the update has been written, so it never holds a
+        state the datastore rejected'''
+        for _ in range(CAS_ATTEMPTS):
+            live = gamecache.LiveGame(urlsafe_game_key)
+            snapshot = live.load()
+            if snapshot is None:
+                break
+            outcome, state, changed, moves = cls._apply(snapshot, apply)
+            if not outcome.changed:
+                raise ndb.Return(outcome)
+            try:
+                yield cls._commit_async(snapshot[0], changed, moves,
+                                        outcome.ended, check_version=True)
+            except _StaleSnapshot:
+                # another update got in first; retry against the snapshot
+                # it published
+                continue
+            if outcome.ended or not live.save(*snapshot):
+                gamecache.evict(urlsafe_game_key)
+            cls._cache_version(state)
+            raise ndb.Return(outcome)
+
+        outcome, state, entities = yield cls._update_txn_async(
+            urlsafe_game_key, apply)
+        if outcome.ended:
+            gamecache.evict(urlsafe_game_key)
+        else:
+            gamecache.refresh(urlsafe_game_key, *entities)
+        if outcome.changed:
+            cls._cache_version(state)
+        raise ndb.Return(outcome)
+
+    @classmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _update_txn_async(cls, urlsafe_game_key, apply):
+        '''Applies an update, reading the game and boards with one
+        get_multi in the same transaction as the write, so two concurrent
+        updates can't both apply to the same state'''
+        entities = yield _game_and_boards_async(urlsafe_game_key)
+        outcome, state, changed, moves = cls._apply(entities, apply)
+        if outcome.changed:
+            yield cls._commit_async(entities[0], changed, moves,
+                                    outcome.ended)
+        raise ndb.Return((outcome, state, entities))
+
+    @staticmethod
+    def _apply(entities, apply):
+        '''Runs apply on states read from (game, board_1, board_2) and
+        copies the result back onto the entities.
+        Returns (outcome, state, changed, moves): the Outcome, the updated
+        GameState, the Boards that changed and the new Moves'''
+        game, board_1, board_2 = entities
+        if not game:
+            raise NotFound('Game not found!')
+        state = _game_state(game)
+        board_states = [_board_state(board_1, state.player_1),
+                        _board_state(board_2, state.player_2)]
+        outcome = apply(state, *board_states)
+        if not outcome.changed:
+            return outcome, state, [], []
+
+        game.game_over = state.game_over
+        game.winner = state.winner
+        game.next_player = User.key_for(state.next_player)
+        game.move_count = state.last_move - len(game.moves)
+        game.version = state.version
+        changed = []
+        for board, board_state in zip([board_1, board_2], board_states):
+            if board_state in outcome.boards:
+                board.set_layers(board_state.ships, board_state.hits,
+                                 board_state.misses)
+                changed.append(board)
+        moves = [Move(key=Move.key_for(game.key, move.number),
+                      player_name=move.player_name,
+                      x=move.x,
+                      y=move.y,
+                      result=move.result)
+                 for move in outcome.moves]
+        return outcome, state, changed, moves
+
+    @staticmethod
+    @ndb.transactional_tasklet(xg=True)
+    def _commit_async(game, boards, moves, ended, check_version=False):
+        '''Writes an update with one put_multi. Ending the game also
+        removes the pairing and counts the game as finished, and a win
+        updates both players' stats and the leaderboard, in the same
+        transaction, stamping the game and the players with the time it
+        finished. With check_version, for updates played against a
+        snapshot, raises _StaleSnapshot unless the stored game is at the
+        version the update was played against, so writes can't land out
+        of order or over each other. Updates played in a transaction
+        already read the game in it, so they skip the check'''
+        if check_version:
+            stored = yield game.key.get_async(use_cache=False)
+            if not stored or stored.version != game.version - 1:
+                raise _StaleSnapshot()
+        if not ended:
+            yield ndb.put_multi_async([game] + boards + moves)
+            return
+
+        game.finished = datetime.datetime.utcnow()
+        finished = [ActivePairing.key_for_game(game).delete_async(),
+                    counter.increment_async(counter.ACTIVE_GAMES, -1)]
+        if game.winner == CANCELED:
+            yield ndb.put_multi_async([game] + boards + moves) + finished
+            return
+
+        player_key = User.key_for(game.winner)
+        if player_key == game.player_1:
+            opponent_key = game.player_2
+        else:
+            opponent_key = game.player_1
+        player, opponent = yield ndb.get_multi_async([player_key,
+                                                      opponent_key])
+        old_pctgs = [player.win_pctg, opponent.win_pctg]
+        player.games_won = player.games_won + 1
+        player.games_played = player.games_played + 1
+        opponent.games_played = opponent.games_played + 1
+        player.last_finished = opponent.last_finished = game.finished
+        new_pctgs = [player.win_pctg, opponent.win_pctg]
+
+        yield (ndb.put_multi_async([game, player, opponent] +
+                                   boards + moves) + finished +
+               [leaderboard.record_changes_async(zip(old_pctgs, new_pctgs))])
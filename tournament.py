@@ -0,0 +1,262 @@
+"""tournament.py - Tournaments and the matchmaking queue.
+
+Both create games through engine.GameEngine.new_games, which writes all of
+a round's games, boards and pairings with one put_multi and one counter
+update. A round robin creates every game up front. A bracket creates one
+round at a time; next_round starts the next once every game of the
+current round is over, with winners (and the first player of a canceled
+game) moving on. A round is claimed on the Tournament in a transaction
+before its games are created, so of two racing requests only one starts
+it. Games created for a tournament that could then not be saved are
+canceled again.
+
+Matchmaking keeps one queue of waiting players per grid size. A player
+joining a queue that has someone else waiting starts a game against them
+at once, and the waiting player is emailed, so neither client has to poll
+for an opponent."""
+
+import itertools
+import logging
+
+from google.appengine.api import app_identity, mail
+from google.appengine.ext import ndb
+
+from engine import CANCELED, COMPUTER_NAME, InvalidRequest, NotFound
+from grid import MAX_GRID_SIZE, MIN_GRID_SIZE
+from models import ArchivedGame, Game, MatchQueue, Tournament, User
+
+ROUND_ROBIN = 'round_robin'
+BRACKET = 'bracket'
+FORMATS = (ROUND_ROBIN, BRACKET)
+MAX_PLAYERS = 64
+
+
+def _seat(p1_name, p2_name):
+    '''The computer can only play as p2'''
+    if p1_name == COMPUTER_NAME:
+        return p2_name, p1_name
+    return p1_name, p2_name
+
+
+def round_robin(players):
+    '''Returns a (p1, p2) pair for every two players'''
+    return [_seat(*pair) for pair in itertools.combinations(players, 2)]
+
+
+def bracket_round(players):
+    '''Pairs players in order for one bracket round.
+    Returns (pairs, byes): the pairs and the odd player out, if any'''
+    pairs = [_seat(*pair) for pair in zip(players[0::2], players[1::2])]
+    return pairs, players[2 * len(pairs):]
+
+
+def create(engine, tournament_format, players, grid_size):
+    '''Starts a tournament. Returns (tournament, games), the games being
+    engine GameStates'''
+    if tournament_format not in FORMATS:
+        raise InvalidRequest('Format must be one of {}'.format(
+            ', '.join(FORMATS)))
+    if not 2 <= len(players) <= MAX_PLAYERS:
+        raise InvalidRequest('A tournament needs 2 to {} players!'.format(
+            MAX_PLAYERS))
+    if len(set(players)) != len(players):
+        raise InvalidRequest('Each player can only enter once!')
+
+    if tournament_format == ROUND_ROBIN:
+        pairs, byes = round_robin(players), []
+    else:
+        pairs, byes = bracket_round(players)
+    games = engine.new_games(pairs, grid_size)
+    tournament = Tournament(format=tournament_format,
+                            players=players,
+                            grid_size=grid_size,
+                            games=_game_keys(games),
+                            byes=byes)
+    try:
+        tournament.put()
+    except Exception:
+        _abandon(engine, games)
+        raise
+    return tournament, games
+
+
+def _game_keys(games):
+    return [ndb.Key(urlsafe=game.key) for game in games]
+
+
+def _abandon(engine, games):
+    '''Cancels games created for a tournament that could not be saved, so
+    their players are free to play each other again'''
+    for game in games:
+        try:
+            engine.cancel(game.key)
+        except Exception:
+            logging.exception('Could not cancel tournament game %s', game.key)
+
+
+def _round_winners(game_keys):
+    '''Returns the winner of each game, or None for games still in play.
+    Games that have been archived are read from the archive'''
+    games = ndb.get_multi(game_keys)
+    missing = [key for key, game in zip(game_keys, games) if not game]
+    archives = dict(zip(missing, ndb.get_multi(
+        [ArchivedGame.key_for(key) for key in missing])))
+    names = Game.user_names([key for game in games if game
+                             for key in (game.player_1, game.player_2)])
+
+    winners = []
+    for key, game in zip(game_keys, games):
+        if game:
+            if not game.game_over:
+                winners.append(None)
+                continue
+            winner, first = game.winner, names[game.player_1]
+        else:
+            archive = archives[key]
+            if not archive:
+                raise NotFound('Tournament game not found!')
+            winner, first = archive.data['winner'], archive.data['player_1']
+        winners.append(first if winner == CANCELED else winner)
+    return winners
+
+
+@ndb.transactional
+def _advance(tournament_key, current_round, **changes):
+    '''Updates a tournament that is still playing current_round. Raises
+    InvalidRequest if another request has moved it on already'''
+    tournament = tournament_key.get()
+    if (tournament.round != current_round or not tournament.games or
+            tournament.winner):
+        raise InvalidRequest('The tournament has already moved on!')
+    tournament.populate(**changes)
+    tournament.put()
+    return tournament
+
+
+@ndb.transactional
+def _start_round(tournament_key, round_number, game_keys):
+    '''Records the games of a round claimed by _advance'''
+    tournament = tournament_key.get()
+    if tournament.round != round_number or tournament.games:
+        raise InvalidRequest('The tournament has already moved on!')
+    tournament.games = game_keys
+    tournament.put()
+    return tournament
+
+
+@ndb.transactional
+def _release_round(tournament_key, previous):
+    '''Puts back a round that was claimed but could not be started.
+    previous is the (round, games, byes) the tournament had before'''
+    tournament = tournament_key.get()
+    if tournament.round == previous[0] + 1 and not tournament.games:
+        tournament.populate(round=previous[0], games=previous[1],
+                            byes=previous[2])
+        tournament.put()
+
+
+def next_round(engine, tournament_key):
+    '''Starts the next round of a bracket once the current one is over.
+    Returns (tournament, games)'''
+    tournament = tournament_key.get()
+    if not isinstance(tournament, Tournament):
+        raise NotFound('Tournament not found!')
+    if tournament.format != BRACKET:
+        raise InvalidRequest('Only brackets are played in rounds!')
+    if tournament.winner:
+        raise InvalidRequest('Tournament is already over, '
+                             '{} won!'.format(tournament.winner))
+    if not tournament.games:
+        raise InvalidRequest('The next round is already being started!')
+
+    winners = _round_winners(tournament.games)
+    if None in winners:
+        raise InvalidRequest('The current round is not over yet!')
+    advancing = winners + tournament.byes
+    if len(advancing) == 1:
+        return _advance(tournament.key, tournament.round,
+                        winner=advancing[0]), []
+
+    # the round is claimed, with no games yet, before they are created, so
+    # a request racing this one fails rather than starting it twice
+    previous = (tournament.round, tournament.games, tournament.byes)
+    pairs, byes = bracket_round(advancing)
+    claimed = _advance(tournament.key, tournament.round,
+                       round=tournament.round + 1, games=[], byes=byes)
+    try:
+        games = engine.new_games(pairs, tournament.grid_size)
+    except Exception:
+        _release_round(tournament.key, previous)
+        raise
+    try:
+        started = _start_round(tournament.key, claimed.round,
+                               _game_keys(games))
+    except Exception:
+        _abandon(engine, games)
+        _release_round(tournament.key, previous)
+        raise
+    return started, games
+
+
+@ndb.transactional
+def _take_opponent(grid_size, user_name):
+    '''Removes and returns the player who has waited longest, or queues
+    user_name and returns None if nobody else is waiting'''
+    queue = MatchQueue.key_for(grid_size).get() or MatchQueue(
+        key=MatchQueue.key_for(grid_size))
+    for name in queue.waiting:
+        if name != user_name:
+            queue.waiting.remove(name)
+            queue.put()
+            return name
+    if user_name not in queue.waiting:
+        queue.waiting.append(user_name)
+        queue.put()
+    return None
+
+
+@ndb.transactional
+def _return_opponent(grid_size, user_name):
+    '''Puts a player back at the front of the queue'''
+    queue = MatchQueue.key_for(grid_size).get() or MatchQueue(
+        key=MatchQueue.key_for(grid_size))
+    if user_name not in queue.waiting:
+        queue.waiting.insert(0, user_name)
+        queue.put()
+
+
+def _notify(user_name, opponent_name, game):
+    user = User.key_for(user_name).get()
+    if not user or not user.email:
+        return
+    app_id = app_identity.get_application_id()
+    mail.send_mail('noreply@{}.appspotmail.com'.format(app_id),
+                   user.email,
+                   'Your Battleship game is ready!',
+                   'Hello {}, {} has joined you for a game of Battleship. '
+                   'Your game key is {}, and you move first.'.format(
+                       user_name, opponent_name, game.key))
+
+
+def join_queue(engine, user_name, grid_size):
+    '''Matches user_name with the player who has waited longest for a game
+    on this grid size, who moves first. Returns the new GameState, or None
+    if user_name has been queued to wait for an opponent'''
+    if user_name == COMPUTER_NAME:
+        raise InvalidRequest('The computer can not join matchmaking!')
+    if not MIN_GRID_SIZE <= grid_size <= MAX_GRID_SIZE:
+        raise InvalidRequest(
+            'Grid size must be between {} and {}'.format(MIN_GRID_SIZE,
+                                                         MAX_GRID_SIZE))
+    if not User.key_for(user_name).get():
+        raise InvalidRequest('Player must be a valid user!')
+    opponent = _take_opponent(grid_size, user_name)
+    if opponent is None:
+        return None
+    try:
+        game = engine.new_game(opponent, user_name, grid_size)
+    except InvalidRequest:
+        _return_opponent(grid_size, opponent)
+        raise
+    _notify(opponent, user_name, game)
+    return game
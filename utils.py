@@ -1,9 +1,26 @@
 """utils.py - File for collecting general utility functions."""
 
 import logging
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
 import endpoints
-from models import Board, Game
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+def get_key_by_urlsafe(urlsafe):
+    """Returns the ndb.Key a urlsafe key string encodes. Raises a
+        BadRequestException if the key String is malformed."""
+    try:
+        return ndb.Key(urlsafe=urlsafe)
+    except TypeError:
+        raise endpoints.BadRequestException('Invalid Key')
+    except Exception, e:
+        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
+            raise endpoints.BadRequestException('Invalid Key')
+        else:
+            raise
+
 
 def get_by_urlsafe(urlsafe, model):
     """Returns an ndb.Model entity that the urlsafe key points to. Checks
@@ -18,16 +35,7 @@ def get_by_urlsafe(urlsafe, model):
         exists.
     Raises:
         ValueError:"""
-    try:
-        key = ndb.Key(urlsafe=urlsafe)
-    except TypeError:
-        raise endpoints.BadRequestException('Invalid Key')
-    except Exception, e:
-        if e.__class__.__name__ == 'ProtocolBufferDecodeError':
-            raise endpoints.BadRequestException('Invalid Key')
-        else:
-            raise
-
+    key = get_key_by_urlsafe(urlsafe)
     entity = key.get()
     if not entity:
         return None
@@ -36,15 +44,25 @@ def get_by_urlsafe(urlsafe, model):
     return entity
 
 
-def get_by_players(p1, p2, model):
-    if model == 'Board':
-        query = Board.query(Board.player == p1)
-        query = query.filter(Board.opponent == p2)
-        board = query.get()
-        return board
-
-    if model == 'Game':
-        query = Game.query(ndb.OR(Game.player_1 == p1, Game.player_2 == p1))
-        query = query.filter(ndb.OR(Game.player_1 == p2, Game.player_2 == p2))
-        game = query.get()
-        return game
+def fetch_page(query, page_size=None, cursor=None):
+    """Fetches one page of query results.
+    Args:
+        query: The ndb.Query to page through
+        page_size: Results per page, capped at MAX_PAGE_SIZE. Raises a
+            BadRequestException if it is negative
+        cursor: urlsafe cursor string returned by the previous page
+    Returns:
+        A (results, next_cursor) tuple, next_cursor being a urlsafe string
+        or None once the last page has been returned."""
+    if page_size is not None and page_size < 0:
+        raise endpoints.BadRequestException('Invalid page size')
+    page_size = min(page_size or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+    try:
+        start_cursor = Cursor(urlsafe=cursor) if cursor else None
+    except Exception:
+        raise endpoints.BadRequestException('Invalid cursor')
+    results, next_cursor, more = query.fetch_page(page_size,
+                                                  start_cursor=start_cursor)
+    if more and next_cursor:
+        return results, next_cursor.urlsafe()
+    return results, None